@@ -0,0 +1,303 @@
+#! /usr/bin/env python
+
+
+#============================================================================
+#
+#  PROJECT: vasp_unfold
+#  FILE:    __main__.py
+#  VERSION: 1.5
+#  DATE:    October 17th 2026
+#
+#
+# Benchmark of vasp_unfold on synthetic POSCAR and PROCAR files. Every
+# stage of the unfolding is timed separately and the timings are
+# reported as JSON, so that they can be compared between versions.
+#
+#============================================================================
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import itertools
+import argparse
+import numpy as np
+
+# Benchmarked modules are imported from the source tree
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src', 'unfolding'))
+
+from utils import translation, version
+from unfolding import build_translations, build_operators, build_projectors
+from unfolding import build_gathers, unfold_block
+from parse import parse_poscar, parse_procar
+from write import write_procar, ProcarWriter
+from api import unfold_into
+from generate import generate
+
+
+def supercell(sstring):
+    '''Parse string with comma separated numbers of unit
+    cells along every lattice vector.
+    '''
+    sc = tuple(int(s) for s in sstring.split(','))
+    
+    if len(sc) != 3 or min(sc) < 1 or max(sc) < 2:
+        raise ValueError('Invalid supercell')
+    
+    return sc
+    
+    
+def timed(timings, stage, func, *args, **kwargs):
+    '''Calls the function and records its wall time under the
+    name of the stage, keeping the shortest of repeated calls.
+    Returns the result of the function.
+    '''
+    start = time.time()
+    
+    result = func(*args, **kwargs)
+    
+    elapsed = time.time()-start
+    
+    timings[stage] = min(timings.get(stage) or elapsed, elapsed)
+    
+    return result
+    
+    
+def project(data, gathers, irreps, order, chunk):
+    '''Unfolds the parsed data onto all irreps in blocks of
+    chunk k-points, as vasp_unfold does.
+    '''
+    npoints = len(data[1])
+    
+    for s in xrange(data[3].shape[-1]):
+        for i in xrange(0, npoints, chunk):
+            block = [data[0], data[1][i:i+chunk], data[2][i:i+chunk]]
+            
+            for a in data[3:]:
+                block.append(np.array(a[i:i+chunk,...,s]))
+            
+            for d in unfold_block(block, gathers, irreps, order):
+                d.weights
+    
+    
+def run_case(workdir, case, repeat, chunk, max_projectors):
+    '''Generates the files of the benchmark case and times
+    every stage of the unfolding. Returns the case report.
+    '''
+    name = 'a{natoms}-s{0}x{1}x{2}-k{npoints}-b{nbands}-o{norbs}-' \
+        'spin{nspin}-dim{ndim}-v{vasp_version}'.format(*case['supercell'],
+        **case)
+    
+    prefix = os.path.join(workdir, name)
+    
+    vasp_version = version(case['vasp_version'])
+    
+    params = dict(case, vasp_version=vasp_version)
+    
+    tgens = generate(prefix, **params)
+    
+    trans, irreps, order = build_translations([translation(t)
+        for t in tgens])
+    
+    cell, spos, symbols = parse_poscar(prefix+'.POSCAR')
+    
+    norbs = case['norbs']
+    
+    # Dense projectors of all irreps
+    projectors_size = len(irreps)*(len(spos)*norbs)**2*16
+    
+    timings = {'build_projectors': None}
+    
+    for r in xrange(repeat):
+        data = timed(timings, 'parse_procar', parse_procar,
+            prefix+'.PROCAR', vasp_version)
+        
+        ops = timed(timings, 'build_operators', build_operators, spos, trans)
+        
+        if projectors_size <= max_projectors:
+            dense = build_operators(spos, trans, dense=True)
+            
+            timed(timings, 'build_projectors', build_projectors, irreps,
+                dense, norbs)
+            
+            del dense
+        
+        gathers = timed(timings, 'build_gathers', build_gathers, ops, norbs)
+        
+        timed(timings, 'projection', project, data, gathers, irreps, order,
+            chunk)
+        
+        timed(timings, 'write_procar', write_procar, prefix+'.out', *data)
+        
+        del data
+        
+        def open_outputs(nirreps, ntotal):
+            return [ProcarWriter('{0}.irrep.{1}'.format(prefix, i))
+                for i in xrange(nirreps)]
+        
+        # Whole run of vasp_unfold writing all irreps
+        timed(timings, 'unfold', unfold_into, open_outputs, prefix+'.POSCAR',
+            prefix+'.PROCAR', tgens, True, vasp_version=vasp_version,
+            chunk=chunk)
+    
+    return {'name': name, 'params': case, 'nions': len(spos),
+            'nirreps': len(irreps),
+            'procar_size': os.path.getsize(prefix+'.PROCAR'),
+            'timings': timings}
+    
+    
+def compare(report, baseline, tolerance, min_time):
+    '''Compares the timings with the baseline report. Returns
+    the list of (case, stage, old, new) for every stage of the
+    same case which became slower than tolerance times the
+    baseline time. Stages shorter than min_time are skipped.
+    '''
+    old = dict((c['name'], c['timings']) for c in baseline['cases'])
+    
+    slower = []
+    
+    for c in report['cases']:
+        for stage, t in sorted(c['timings'].items()):
+            t0 = old.get(c['name'], {}).get(stage)
+            
+            if t is None or t0 is None or max(t, t0) < min_time:
+                continue
+            
+            if t > tolerance*t0:
+                slower.append((c['name'], stage, t0, t))
+    
+    return slower
+    
+    
+def main():
+    desc_str = 'Benchmark of vasp_unfold on synthetic POSCAR and PROCAR '\
+               'files of supercells with known translational symmetry. '\
+               'A case is run for every combination of the given '\
+               'numbers of orbitals, spin components, weight blocks '\
+               'and VASP versions. Parsing, building of operators, '\
+               'projectors and gathers, projection, writing and the '\
+               'whole unfolding are timed separately and reported as '\
+               'JSON.'
+    
+    parser = argparse.ArgumentParser(prog='bench', description=desc_str)
+    
+    parser.add_argument('--atoms', type=int, default=4, help='Number of '
+                        'atoms in the unit cell. Default is 4.')
+    
+    parser.add_argument('--supercell', type=supercell, default=(2, 2, 1),
+                        metavar='SX,SY,SZ', help='Number of unit cells in '
+                        'the supercell along every lattice vector. Default '
+                        'is 2,2,1.')
+    
+    parser.add_argument('--kpoints', type=int, default=20, help='Number of '
+                        'k-points. Default is 20.')
+    
+    parser.add_argument('--bands', type=int, default=40, help='Number of '
+                        'bands. Default is 40.')
+    
+    parser.add_argument('--norbs', type=int, nargs='+', choices=[9, 16],
+                        default=[9], help='Numbers of orbitals per atom. '
+                        'Default is 9.')
+    
+    parser.add_argument('--spin', type=int, nargs='+', choices=[1, 2],
+                        default=[1], help='Numbers of spin components. '
+                        'Default is 1.')
+    
+    parser.add_argument('--ndim', type=int, nargs='+', choices=[1, 4],
+                        default=[1], help='Numbers of weight blocks per '
+                        'band, 4 for non-collinear calculations. Default '
+                        'is 1.')
+    
+    parser.add_argument('--vasp-version', nargs='+', choices=['5.2.2',
+                        '5.4.4'], default=['5.2.2'], help='Versions of VASP '
+                        'whose PROCAR format is used. Default is 5.2.2.')
+    
+    parser.add_argument('--chunk', type=int, default=64, help='Number of '
+                        'k-points unfolded at once. Default is 64.')
+    
+    parser.add_argument('--repeat', type=int, default=3, help='Number of '
+                        'repetitions. Shortest time of every stage is '
+                        'reported. Default is 3.')
+    
+    parser.add_argument('--max-projectors', type=float, default=1,
+                        help='Maximal size of dense projectors in GB. '
+                        'Building of larger projectors is skipped. Default '
+                        'is 1.')
+    
+    parser.add_argument('--workdir', type=str, help='Directory for the '
+                        'generated files, which are kept. By default, a '
+                        'temporary directory is used and removed.')
+    
+    parser.add_argument('--out', type=str, help='Output JSON file. By '
+                        'default, report is written to standard output.')
+    
+    parser.add_argument('--baseline', type=str, help='JSON report of an '
+                        'earlier run. Stages which became slower are '
+                        'reported and the exit status is 1.')
+    
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='Ratio of new and baseline times above which '
+                        'a stage is considered slower. Default is 1.25.')
+    
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='Stages shorter than this in seconds are not '
+                        'compared. Default is 0.05.')
+    
+    args = parser.parse_args()
+    
+    if args.workdir is None:
+        workdir = tempfile.mkdtemp(prefix='vasp_unfold_bench.')
+    else:
+        workdir = args.workdir
+        
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+    
+    report = {'benchmark': 'vasp_unfold', 'version': 1,
+              'python': platform.python_version(), 'numpy': np.__version__,
+              'platform': platform.platform(), 'repeat': args.repeat,
+              'chunk': args.chunk, 'cases': []}
+    
+    try:
+        for norbs, nspin, ndim, vasp_version in itertools.product(
+                args.norbs, args.spin, args.ndim, args.vasp_version):
+            case = {'natoms': args.atoms, 'supercell': list(args.supercell),
+                    'npoints': args.kpoints, 'nbands': args.bands,
+                    'norbs': norbs, 'nspin': nspin, 'ndim': ndim,
+                    'vasp_version': vasp_version}
+            
+            report['cases'].append(run_case(workdir, case, args.repeat,
+                args.chunk, args.max_projectors*2**30))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    text = json.dumps(report, indent=1, sort_keys=True)
+    
+    if args.out is None:
+        sys.stdout.write(text+'\n')
+    else:
+        with open(args.out, 'w') as f:
+            f.write(text+'\n')
+    
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        
+        slower = compare(report, baseline, args.tolerance, args.min_time)
+        
+        for name, stage, t0, t in slower:
+            sys.stderr.write('Slower: {0} {1} {2:.3f} s -> {3:.3f} s\n'.format(
+                name, stage, t0, t))
+        
+        if slower:
+            sys.exit(1)
+    
+    
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#===========================================================
+#
+#  PROJECT: vasp_unfold
+#  FILE:    generate.py
+#  VERSION: 1.5
+#  DATE:    October 17th 2026
+#
+#===========================================================
+
+import numpy as np
+from write import orblabels, open_procar, format_kpoints
+
+
+def supercell_positions(natoms, supercell, rng):
+    '''Returns fractional positions of atoms in the supercell
+    built by repeating a unit cell with natoms atoms at random
+    positions. Supercell is given by the number of unit cells
+    along every lattice vector.
+    '''
+    base = rng.rand(natoms, 3)
+    
+    cells = np.indices(supercell).reshape((3, -1)).T
+    
+    spos = (cells[:,np.newaxis]+base)/np.array(supercell, float)
+    
+    return spos.reshape((-1, 3))%1
+    
+    
+def write_poscar(fname, spos, supercell):
+    '''Writes the POSCAR file with the given fractional positions
+    of atoms in the supercell of cubic unit cells.
+    '''
+    with open(fname, 'w') as out:
+        out.write('Synthetic {0}x{1}x{2} supercell\n1.0\n'.format(*supercell))
+        
+        for v in np.diag([3.0*s for s in supercell]):
+            out.write(' {0:.6f} {1:.6f} {2:.6f}\n'.format(*v))
+        
+        out.write('Fe\n{0}\nDirect\n'.format(len(spos)))
+        
+        for p in spos:
+            out.write(' {0:.10f} {1:.10f} {2:.10f}\n'.format(*p))
+    
+    
+def random_kpoints(rng, orbitals, kpoints, kweights, nbands, nions, ndim):
+    '''Returns data list of a block of k-points, as yielded by
+    iter_procar, with random bands, weights and phases.
+    '''
+    norb = len(orbitals)
+    nk = len(kpoints)
+    
+    bands = rng.randn(nk, nbands)*3
+    occupancies = rng.rand(nk, nbands)
+    
+    weights = rng.rand(nk, nions*norb, nbands, ndim)*0.3
+    phases = (rng.randn(nk, nions*norb, nbands)+
+        1j*rng.randn(nk, nions*norb, nbands))*0.3
+    
+    return [orbitals, kpoints, kweights, bands, occupancies, weights, phases]
+    
+    
+def format_kpoints_544(first, npoints, orbitals, kpoints, kweights,
+                       bands, occupations, weights, phases):
+    '''Formats a block of k-points as format_kpoints, but with
+    phases in the format of VASP 5.4.4, where every ion has a
+    single line of real and imaginary parts of all orbitals and
+    their total, followed by the line with charges.
+    '''
+    norb = len(orbitals)
+    nk, nbands = bands.shape
+    nions = weights.shape[1]/norb
+    ndim = weights.shape[-1]
+    
+    orb_ttl_1 = 'ion '+''.join('{0: >6} '.format(orblabels[i])
+        for i in xrange(norb))+'{0: >6}\n'.format('tot')
+    orb_ttl_2 = 'ion '+''.join('{0: >14} '.format(orblabels[i])
+        for i in xrange(norb))+'{0: >14}\n'.format('tot')
+    
+    # Every k-point is written with a single format operation
+    row = '%6.3f '*norb
+    
+    block = ''.join('{0: >3} '.format(k+1)+row+'%6.3f\n'
+        for k in xrange(nions))
+    block += 'tot '+row+'%6.3f\n'
+    
+    prow = ' %6.3f %6.3f'*norb+' %6.3f\n'
+    
+    band = 'band %4d # energy %13.8f # occ. %11.8f\n\n'+orb_ttl_1+\
+        block*ndim+orb_ttl_2
+    band += ''.join('{0: >5}'.format(k+1)+prow for k in xrange(nions))
+    band += 'charge'+prow+'\n'
+    
+    template = ' k-point %4d :    %.8f %.8f %.8f     weight = %.8f\n\n'+\
+        band*nbands+'\n'
+    
+    w = weights.reshape((nk, nions, norb, nbands, ndim))
+    w = w.transpose((0, 3, 4, 1, 2))
+    
+    # Table of weights with totals in the last row and column
+    table = np.zeros((nk, nbands, ndim, nions+1, norb+1), float)
+    
+    table[:,:,:,:nions,:norb] = w
+    table[:,:,:,nions,:norb] = np.sum(w, axis=3)
+    table[:,:,:,:,norb] = np.sum(table[:,:,:,:,:norb], axis=-1)
+    
+    # Interleaved real and imaginary parts with magnitude totals
+    p = phases.reshape((nk, nions, norb, nbands)).transpose((0, 3, 1, 2))
+    p = np.concatenate((p, np.sum(p, axis=2)[:,:,np.newaxis]), axis=2)
+    
+    ptable = np.zeros((nk, nbands, nions+1, 2*norb+1), float)
+    
+    ptable[...,0:2*norb:2] = p.real
+    ptable[...,1:2*norb:2] = p.imag
+    ptable[...,2*norb] = np.sum(np.abs(ptable[...,:2*norb]), axis=-1)
+    
+    values = np.concatenate([np.reshape(v, (nk, nbands, -1)) for v in
+        [np.arange(1, nbands+1)*np.ones((nk, 1)), bands, occupations,
+         table, ptable]], axis=-1)
+    
+    values = np.concatenate((np.arange(first+1, first+nk+1)[:,np.newaxis],
+        kpoints, kweights[:,np.newaxis], values.reshape((nk, -1))), axis=1)
+    
+    text = []
+    
+    if first == 0:
+        text.append('# of k-points:  {0}         # of bands:  {1}'
+              '         # of ions:   {2}\n\n'.format(npoints, nbands, nions))
+    
+    for v in values:
+        text.append(template % tuple(v.tolist()))
+    
+    return ''.join(text)
+    
+    
+def generate(prefix, natoms=4, supercell=(2, 2, 1), npoints=20, nbands=40,
+             norbs=9, nspin=1, ndim=1, vasp_version=(5, 2, 2), chunk=16,
+             seed=0):
+    '''Writes synthetic POSCAR and PROCAR files to prefix.POSCAR
+    and prefix.PROCAR. Supercell is made of unit cells with natoms
+    atoms, so that it is symmetric under the translations by the
+    unit cell vectors. PROCAR holds random bands, weights and
+    phases for norbs orbitals per atom, nspin spin components and
+    ndim weight blocks per band (4 for non-collinear calculations)
+    in the format written by the given version of VASP. K-points
+    are generated and written in blocks of chunk k-points, so that
+    the memory used does not depend on the size of the file.
+    Returns the translation generators as strings.
+    '''
+    rng = np.random.RandomState(seed)
+    
+    spos = supercell_positions(natoms, supercell, rng)
+    
+    write_poscar(prefix+'.POSCAR', spos, supercell)
+    
+    orbitals = orblabels[:norbs]
+    
+    # Spin components share the k-points
+    kpoints = rng.rand(npoints, 3)*0.5
+    kweights = np.ones(npoints)/npoints
+    
+    if vasp_version < (5, 4, 4):
+        fmt = format_kpoints
+    else:
+        fmt = format_kpoints_544
+    
+    out = open_procar(prefix+'.PROCAR', True)
+    
+    try:
+        for s in xrange(nspin):
+            for i in xrange(0, npoints, chunk):
+                data = random_kpoints(rng, orbitals, kpoints[i:i+chunk],
+                    kweights[i:i+chunk], nbands, len(spos), ndim)
+                
+                out.write(fmt(i, npoints, *data))
+    finally:
+        out.close()
+    
+    # Generators are the unit cell vectors
+    tgens = []
+    
+    for i, n in enumerate(supercell):
+        if n > 1:
+            t = ['0', '0', '0']
+            t[i] = '1/{0}'.format(n)
+            
+            tgens.append(','.join(t))
+    
+    return tgens
@@ -15,14 +15,18 @@ PYTHON_COMMAND="python"
 ENV_COMMAND="/usr/bin/env"
 
 
-SRC_FILES="__main__.py parse.py unfolding.py utils.py write.py errors.py"
+SRC_FILES="__main__.py parse.py unfolding.py utils.py write.py errors.py cache.py parallel.py api.py profiler.py streams.py reader.py"
 PLOT_SRC_FILES="__main__.py"
 
+# Files of vasp_unfold used by the fatplot
+PLOT_SHARED_FILES="streams.py reader.py errors.py"
+
 # Change into source directory
 cd src
 
 # Zip the source files
 cd unfolding; zip ../../${VASP_UNFOLD}.zip ${SRC_FILES}; cd ..;
+cd unfolding; zip ../../${PLOT}.zip ${PLOT_SHARED_FILES};    cd ..;
 cd plot;      zip ../../${PLOT}.zip ${PLOT_SRC_FILES};   cd ..;
 
 cd ..
@@ -11,12 +11,23 @@
 
 
 import os
+import sys
+import json
 import numpy as np
 import argparse
 
+# Modules shared with vasp_unfold are packed into the fatplot
+# executable, and taken from src/unfolding in the source tree
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'unfolding'))
+
+from streams import open_stream
+from reader import parse_rows
+
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plot
+import matplotlib.colors as colors
 
 # Handle color arguments
 def color(string):
@@ -27,14 +38,166 @@ def color(string):
         # If cannot convert to tuple just
         # return the original string
         return string
-
+    
+    
+def read_procar(fname, bufsize=2**24):
+    '''Reads k-points, band energies and total orbital weights
+    of the first weight block of every band from the PROCAR 
+    file in a single pass. Lines holding them are told apart
+    by their first two characters in every buffer at once, and
+    only they are parsed. Returns the (npoints,3) array of
+    k-points and (npoints,nbands) arrays of energies and 
+    weights, in which bands of the second spin component 
+    follow the ones of the first.
+    '''
+    # Kinds of lines by their first two characters
+    kinds = np.zeros(2**16, np.int8)
+    
+    for k, start in enumerate(['ba', 'to', ' k', '# '], 1):
+        kinds[ord(start[0])*256+ord(start[1])] = k
+    
+    sizes = None
+    
+    kpoints = []
+    bands = []
+    weights = []
+    
+    # Incomplete last line of the previous buffer
+    tail = b''
+    
+    # Kind of the last selected line of the previous buffer
+    last = 0
+    
+    stream = open_stream(fname, 'rb', True)
+    
+    try:
+        while tail is not None:
+            more = stream.read(bufsize)
+            
+            if more:
+                buff = tail+more
+            else:
+                # Terminate the last line
+                buff = tail+b'\n'
+            
+            data = np.frombuffer(buff, np.uint8)
+            
+            ends = np.flatnonzero(data == 10)
+            
+            if len(ends) == 0:
+                tail = buff
+                
+                continue
+            
+            starts = np.append(0, ends[:-1]+1)
+            
+            # Second character of a blank line is 
+            # the first character of the next line
+            c0 = data[starts].astype(np.uint16)
+            c1 = data[np.minimum(starts+1, len(data)-1)]
+            
+            kind = kinds[c0*256+c1]
+            
+            rows = np.flatnonzero(kind)
+            kind = kind[rows]
+            
+            # Only the first line with totals after the band
+            # line belongs to the first weight block
+            prev = np.append(last, kind[:-1])
+            
+            if len(kind) > 0:
+                last = kind[-1]
+            
+            lines = [buff[starts[r]:ends[r]].split() for r in 
+                rows[kind != 2]]
+            
+            for line, k in zip(lines, kind[kind != 2]):
+                if k == 1:
+                    bands.append(line[4])
+                elif k == 3:
+                    kpoints.append(line[3:6])
+                elif sizes is None:
+                    sizes = int(line[3]), int(line[7])
+            
+            # Totals are in the last column, after the label
+            r = rows[(kind == 2) & (prev == 1)]
+            
+            if len(r) > 0:
+                w = parse_rows(buff, starts[r]+3, ends[r])
+                
+                weights.append(w.reshape((len(r), -1))[:,-1])
+            
+            tail = buff[ends[-1]+1:] if more else None
+    finally:
+        stream.close()
+    
+    bands = np.array(bands, float)
+    weights = np.concatenate(weights or [[]])
+    
+    # Every spin component has to be complete
+    if sizes is None or len(bands) == 0 or len(weights) != len(bands) \
+            or len(bands)%(sizes[0]*sizes[1]) != 0:
+        raise ValueError('Unable to read "{0}".'.format(fname))
+    
+    npoints, nbands = sizes
+    
+    kpoints = np.array(kpoints[:npoints], float)
+    
+    # Spin components are joined along the band axis
+    bands = bands.reshape((-1, npoints, nbands))
+    bands = bands.transpose((1, 0, 2)).reshape((npoints, -1))
+    
+    weights = weights.reshape((-1, npoints, nbands))
+    weights = weights.transpose((1, 0, 2)).reshape((npoints, -1))
+    
+    return kpoints, bands, weights
+    
+
+def bin_weights(x, bands, weights, bins, erange, wmin=0):
+    '''Accumulates orbital weights of all bands into the 2D
+    histogram of path distance x and energy, with bins given
+    as (nx,ne), over the whole path and the energy range. 
+    Weights not larger than wmin and energies outside of the
+    range are left out. Bands are binned in blocks, so that
+    the memory used depends on the number of bins and not on 
+    the number of bands. Returns the (nx,ne) histogram.
+    '''
+    nx, ne = bins
+    emin, emax = erange
+    
+    # Distance bin of every k-point is shared by all bands
+    span = max(x[-1]-x[0], 1e-12)
+    ix = np.minimum(((x-x[0])/span*nx).astype(int), nx-1)
+    
+    hist = np.zeros(nx*ne, float)
+    
+    # Number of bands binned at once
+    block = max(1, 2**20/len(x))
+    
+    for i in xrange(0, bands.shape[1], block):
+        e = np.asarray(bands[:,i:i+block])
+        w = np.asarray(weights[:,i:i+block])
+        
+        ie = np.floor((e-emin)/(emax-emin)*ne).astype(int)
+        
+        keep = (w > wmin) & (ie >= 0) & (ie < ne)
+        
+        index = (ix[:,np.newaxis]*ne+ie)[keep]
+        
+        hist += np.bincount(index, weights=w[keep], minlength=nx*ne)
+    
+    return hist.reshape((nx, ne))
+    
+    
 desc_str = '''Simple program used to quickly plot the orbital weights
 of the band structure contained in the specified PROCAR file.
 '''
 
 parser = argparse.ArgumentParser(prog='fatplot', description = desc_str)
 
-parser.add_argument('procar', type=str, help='POSCAR file')
+parser.add_argument('procar', type=str, help='PROCAR file, possibly '
+                    'compressed (.gz, .bz2, .xz or .zst), or directory '
+                    'written by vasp_unfold with --format npy')
 parser.add_argument('output', type=str, help='Filename for the plot. It accepts '
                     'all image formats supported by matplotlib.')
 
@@ -60,43 +223,56 @@ parser.add_argument('--pow', type=float, default=1,
                     help='Raise orbital weights to the specified integer power. '
                     'Powers larger than 1 help to filter out the ghost bands '
                     'in the unfolded band structures.')
+parser.add_argument('--wmin', type=float, default=0,
+                    help='Points with orbital weights (after raising them to '
+                    '--pow) not larger than this are not plotted. Default is 0.')
+parser.add_argument('--rasterize', action='store_true',
+                    help='Rasterize the markers, so that vector images '
+                    '(PDF, SVG) stay small. Lines and axes are not rasterized.')
+parser.add_argument('--density', action='store_true',
+                    help='Plot the spectral density, i.e. the weights summed '
+                    'over the bins of path distance and energy, as an image '
+                    'instead of the fat bands.')
+parser.add_argument('--bins', type=eval, default=(600, 400),
+                    help='Number of bins along the path and energy for '
+                    '--density, formatted as nx,ne (no spaces allowed). '
+                    'Default is 600,400.')
                     
 args = parser.parse_args()
 
 
-# Commands to extract the needed information from the PROCAR file
-grep_npoints = 'grep -m 1 "of k\-points" {0} | tr -s " " | cut -d" " -f4'
-grep_kpoints = 'grep -E "^ k\-point " {0} | tr -s " " | cut -d" " -f5-7'
-grep_bands = 'grep -E "^band" {0} | tr -s " " |  cut -d" " -f5'
-grep_weights = 'grep -E "^tot" {0} | tr -s " " |  cut -d" " -f11'
-
-# Extract the number of k-points
-npoints = int(os.popen(grep_npoints.format(args.procar)).read())
-
-# Extract the k-points
-kpoints = os.popen(grep_kpoints.format(args.procar))
-kpoints = np.fromfile(kpoints, count=3*npoints, dtype=float, sep=' ')
-
-# Extract the band energies
-bands = os.popen(grep_bands.format(args.procar))
-bands = np.fromfile(bands, count=-1, dtype=float, sep=' ')
-
-# Extract the total orbital weights for each band
-weights = os.popen(grep_weights.format(args.procar))
-weights = np.fromfile(weights, count=-1, dtype=float, sep=' ')
-
-# Figure out the number of bands
-nbands = len(bands)/npoints
-
-# Figure out the number of orbital blocks per band
-# 1 for collinear calculation, 4 for non-collinear
-# In non-collinear case we just need the first one
-wdim = len(weights)/(npoints*nbands)
-
-# Reshape the arrays into their proper shapes
-kpoints = kpoints.reshape((npoints, 3))
-bands = bands.reshape((npoints, nbands))-args.efermi
-weights = weights[::wdim].reshape((npoints, nbands))
+if os.path.isdir(args.procar):
+    # Binary output of vasp_unfold (--format npy). Arrays
+    # are memory mapped as described by the manifest
+    with open(os.path.join(args.procar, 'manifest.json')) as f:
+        manifest = json.load(f)
+    
+    def load(name):
+        return np.load(os.path.join(args.procar, 
+            manifest['arrays'][name]['file']), mmap_mode='r')
+    
+    kpoints = np.array(load('kpoints'))
+    
+    npoints = len(kpoints)
+    
+    # Bands of both spin components are plotted together
+    bands = load('bands')
+    bands = bands.transpose((0, 2, 1)).reshape((npoints, -1))-args.efermi
+    
+    nbands = bands.shape[1]
+    
+    # Total weights of the first orbital weight block
+    weights = load('weights')
+    weights = np.array([np.sum(weights[i,:,:,0,:], axis=0) 
+        for i in xrange(npoints)])
+    weights = weights.transpose((0, 2, 1)).reshape((npoints, nbands))
+else:
+    # PROCAR file, possibly compressed, is read in a single pass
+    kpoints, bands, weights = read_procar(args.procar)
+    
+    npoints = len(kpoints)
+    
+    bands -= args.efermi
 
 # Raise the weights to the specified power
 if args.pow != 1:
@@ -128,6 +304,11 @@ xsym = x[ipoint]
 e_low = np.min(bands)-1.0
 e_high = np.max(bands)+1.0
 
+if args.elim[0] < args.elim[1]:
+    erange = args.elim
+else:
+    erange = (e_low, e_high)
+
 plot.figure(figsize=args.figsize)
 
 # Plot horizontal line for the Fermi level
@@ -137,18 +318,34 @@ plot.plot(x[[0,-1]], [0, 0], color='gray', zorder=-1)
 for xi in xsym:
     plot.plot([xi, xi], [e_low, e_high], color='gray', zorder=-1)
 
-# Plot the weights
-for bi, wi in zip(bands.T, weights.T):
-    plot.scatter(x, bi, s=args.markersize*wi, marker=args.marker, 
-                 color=args.color, lw=0)
+if args.density:
+    # Weights are binned over the plotted area, and the
+    # bins are colored from white to the marker color
+    hist = bin_weights(x, bands, weights, args.bins, erange, args.wmin)
 
-# Fix x and y-axis boundaries
-plot.xlim(x[0], x[-1])
+    cmap = colors.LinearSegmentedColormap.from_list('density', 
+        ['white', args.color])
 
-if args.elim[0] < args.elim[1]:
-    plot.ylim(*args.elim)
+    plot.imshow(hist.T, origin='lower', extent=(x[0], x[-1])+tuple(erange),
+                aspect='auto', interpolation='nearest', cmap=cmap, vmin=0,
+                zorder=-2)
 else:
-    plot.ylim(e_low, e_high)
+    # All points are drawn as a single collection, band
+    # after band, leaving out the ones with small weights
+    xs = np.tile(x, bands.shape[1])
+    es = np.ravel(bands.T)
+    ws = np.ravel(weights.T)
+    
+    keep = ws > args.wmin
+    
+    # Plot the weights
+    plot.scatter(xs[keep], es[keep], s=args.markersize*ws[keep], 
+                 marker=args.marker, color=args.color, lw=0, 
+                 rasterized=args.rasterize)
+
+# Fix x and y-axis boundaries
+plot.xlim(x[0], x[-1])
+plot.ylim(*erange)
 
 # Set x-axis ticks
 plot.xticks(xsym, ['']*len(xsym))
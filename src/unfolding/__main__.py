@@ -26,11 +26,16 @@
 import numpy as np
 import argparse
 import sys
-from utils import post_error, translation, version
-from unfolding import build_translations, build_operators, build_projectors
-from parse import parse_poscar, parse_procar
-from write import write_procar
-import errors
+import os
+from utils import post_error, translation, version, energy_grid, selection
+from utils import join_values
+from write import ProcarWriter, NpyWriter, SpectralWriter, MultiWriter
+from parse import parse_batch
+from cache import entry_size
+from streams import compression, strip_compression
+from profiler import Profiler
+from api import unfold_into, unfold_batch
+from errors import UnfoldingError, InputError, OutputError
 
 def main():
     desc_str = 'Unfold bands calculated by VASP. For this, phase '\
@@ -49,8 +54,8 @@ def main():
                
     parser = argparse.ArgumentParser(prog='vasp_unfold', description = desc_str)
 
-    parser.add_argument('poscar', type=str, help='POSCAR file')     
-    parser.add_argument('procar', type=str, help='PROCAR file')
+    parser.add_argument('poscar', type=str, nargs='?', help='POSCAR file')     
+    parser.add_argument('procar', type=str, nargs='?', help='PROCAR file')
 
     parser.add_argument('--tgen', type=translation, action='append',
                         metavar='SX,SY,SZ', help='Fractional translation '
@@ -61,8 +66,9 @@ def main():
 
     parser.add_argument('--out', type=str, help='Output filename. If left '
                         'unspecified  output is writen to PROCAR.irrep.n '
-                        'where PROCAR is location of the input PROCAR file. '
-                        'If specified, output is written to OUT.irrep.n.')
+                        'where PROCAR is location of the input PROCAR file '
+                        '(without the compression extension). If specified, '
+                        'output is written to OUT.irrep.n.')
     
     parser.add_argument('--eps', type=float, default=1e-6, help='Numerical '
                         'precision. When building permutation representation '
@@ -88,66 +94,290 @@ def main():
     parser.add_argument('--vasp-version', type=version, default='5.2.2', help='Version of VASP'
                         'that produced the PROCAR file. All versions prior to 5.4.4'
                         'use the same format. Since 5.4.4 there is a new format.')
-                        
-    args = parser.parse_args()
     
-    tgens = args.tgen
+    parser.add_argument('--chunk', type=int, default=64, help='Number of '
+                        'k-points which are unfolded at once. PROCAR file is '
+                        'processed in blocks of k-points, so the memory usage '
+                        'is proportional to the chunk size. Default is 64.')
     
-    trans, irreps = build_translations(tgens)
+    parser.add_argument('--precision', choices=['single', 'double'],
+                        default='double', help='Floating point precision '
+                        'used to store and unfold orbital weights and phases. '
+                        'Since PROCAR holds only three decimals, single '
+                        'precision is sufficient and halves the memory usage. '
+                        'Default is double.')
     
-    try:
-        cell, spos, symbols = parse_poscar(args.poscar)
-    except:
-        post_error('Unable to parse the input POSCAR file. Please '
-            'check if the file exists and is formatted properly.', True)
+    parser.add_argument('--cache-dir', type=str, help='Directory for the '
+                        'cache of translation operators and parsed PROCAR '
+                        'files. If specified, operators built for a '
+                        'structure and parsed data are stored in binary form, '
+                        'and subsequent runs on the same structure and '
+                        'unmodified PROCAR file skip building and parsing '
+                        'them. By default, nothing is cached.')
+    
+    parser.add_argument('--cache-size', type=float, default=10, help='Maximal '
+                        'size of the cache directory in GB. Least recently '
+                        'used entries are removed to stay below it. Default '
+                        'is 10.')
+    
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='Disables caching even if --cache-dir is given.')
+    
+    parser.add_argument('--format', choices=['procar', 'npy'], 
+                        default='procar', help='Output format. With procar, '
+                        'every irrep is written as a text PROCAR file. With '
+                        'npy, every irrep is written as a directory holding '
+                        'k-points, bands, occupancies, weights and phases as '
+                        'NumPy .npy files, which can be memory mapped, and '
+                        'a manifest.json file describing them. Default is '
+                        'procar.')
+    
+    parser.add_argument('--compress', choices=['none', 'gz', 'bz2', 'xz', 
+                        'zst'], help='Compression of the output PROCAR '
+                        'files, whose names get the corresponding extension. '
+                        'Input POSCAR and PROCAR files with these extensions '
+                        'are decompressed while being read. By default, '
+                        'output is compressed in the same way as the input '
+                        'PROCAR file. Ignored with --format npy.')
+    
+    parser.add_argument('--atoms', type=selection, metavar='ATOMS', 
+                        help='Comma separated atoms which are unfolded and '
+                        'written to the output, given by their numbers '
+                        '(starting from 1, as in PROCAR), ranges such as 1-4 '
+                        'or chemical symbols. Only the atoms in translation '
+                        'orbits of the selected atoms are parsed and '
+                        'projected. Atoms are written in the order of the '
+                        'POSCAR file with their own numbers. By default, all '
+                        'atoms are unfolded.')
+    
+    parser.add_argument('--orbitals', type=selection, metavar='ORBITALS',
+                        help='Comma separated orbitals which are unfolded '
+                        'and written to the output, given by their labels '
+                        'in PROCAR (eg. dxy) or by s, p, d and f for all '
+                        'orbitals of the angular momentum. By default, all '
+                        'orbitals are unfolded.')
+    
+    parser.add_argument('--spectral', type=energy_grid, 
+                        metavar='EMIN,EMAX,NE', help='Writes the unfolded '
+                        'spectral function of irrep 0, with every band '
+                        'broadened on the grid of NE energies from EMIN to '
+                        'EMAX (in eV, no whitespaces allowed, eg. -5,5,501) '
+                        'and weighted by its total unfolded orbital weight. '
+                        'It is written to OUT.spectral.s.npy for every spin '
+                        'component s, as (k-points,NE) array in single '
+                        'precision.')
+    
+    parser.add_argument('--broadening', type=float, default=0.05, 
+                        help='Half width at half maximum of the Lorentzian, '
+                        'or standard deviation of the Gaussian, used by '
+                        '--spectral in eV. Default is 0.05.')
+    
+    parser.add_argument('--smearing', choices=['lorentzian', 'gaussian'],
+                        default='lorentzian', help='Line shape of the bands '
+                        'in the spectral function. Default is lorentzian.')
+    
+    parser.add_argument('--jobs', type=int, default=1, help='Number of '
+                        'worker processes. With more than one job, parsed '
+                        'PROCAR file is stored in binary form (in the cache '
+                        'if --cache-dir is given, otherwise in a temporary '
+                        'directory next to the output, which needs disk '
+                        'space for the parsed arrays) and blocks of k-points '
+                        'are unfolded in parallel. Default is 1.')
     
-    ops = build_operators(spos, trans, args.check_mapping, args.eps)
+    parser.add_argument('--writers', type=int, default=1, help='Number of '
+                        'threads writing the irrep outputs concurrently. '
+                        'Default is 1.')
+    
+    parser.add_argument('--max-irreps', type=int, help='Maximal number of '
+                        'unfolded blocks of k-points held in memory while '
+                        'waiting to be written. Default is twice the number '
+                        'of writers.')
+                        
+    parser.add_argument('--batch', type=str, metavar='MANIFEST', help='JSON '
+                        'manifest of a batch of jobs, given instead of POSCAR '
+                        'and PROCAR files. It holds a list of objects with '
+                        'the locations of POSCAR and PROCAR files under '
+                        '"poscar" and "procar", and optionally generators '
+                        'under "tgen" (list of strings, --tgen by default), '
+                        'output prefix under "out" (PROCAR location by '
+                        'default) and VASP version under "vasp_version". '
+                        'Jobs with the same structure and generators are '
+                        'grouped and share the translation operators. With '
+                        '--jobs, PROCAR files of a group are unfolded in '
+                        'parallel, each by a single process.')
+    
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Records wall time, CPU time and peak memory '
+                        'of every stage of the run (POSCAR parsing, building '
+                        'of translations, operators and gathers, PROCAR '
+                        'parsing, projection and writing of every irrep) '
+                        'together with k-points per second and MB per second '
+                        'read and written. The report is written as JSON to '
+                        'OUT.profile.json, or MANIFEST.profile.json in batch '
+                        'mode.')
     
     try:
-        data = parse_procar(args.procar, args.vasp_version)
-    except Exception as exc:
-        post_error(errors.poscar_parse_error, True)
+        # Lowest energy of the grid is usually negative
+        args = parser.parse_args(join_values(sys.argv[1:], ['--spectral']))
+        
+        profiler = Profiler(args.profile)
+        
+        # Locations of the outputs, whose sizes are reported
+        args.outputs = []
+        
+        if args.out is None:
+            output = args.procar and strip_compression(args.procar)
+        else:
+            output = args.out
+        
+        if args.broadening <= 0:
+            raise InputError('Broadening must be positive.')
+        
+        if args.precision == 'single':
+            dtype = np.float32
+        else:
+            dtype = float
+        
+        # Cache is used only if its directory is given
+        if args.no_cache:
+            args.cache_dir = None
+        
+        options = dict(all_irreps=args.all_irreps, eps=args.eps, 
+            check_mapping=args.check_mapping, 
+            vasp_version=args.vasp_version, chunk=args.chunk, dtype=dtype,
+            cache_dir=args.cache_dir, cache_size=args.cache_size*2**30, 
+            writers=args.writers, max_irreps=args.max_irreps,
+            operators_cache=args.cache_dir, profiler=profiler,
+            atoms=args.atoms, orbitals=args.orbitals)
+        
+        if args.batch is not None:
+            run_batch(args, options, profiler)
+            
+            return
+        
+        if args.poscar is None or args.procar is None:
+            raise InputError('POSCAR and PROCAR files have to be specified.')
+        
+        def open_writers(nirreps, ntotal):
+            return open_outputs(args, output, args.procar, nirreps, ntotal)
+        
+        # Temporary files of the workers are kept next to the output.
+        # Workers format the text, unless the spectral function
+        # is computed from the unfolded blocks
+        unfold_into(open_writers, args.poscar, args.procar, args.tgen, 
+            jobs=args.jobs, text=args.format == 'procar' and 
+            args.spectral is None, 
+            workdir=os.path.dirname(os.path.abspath(output)), **options)
+        
+        if args.profile:
+            write_profile(profiler, args.outputs, output+'.profile.json')
+    except UnfoldingError as exc:
+        post_error(str(exc), exc.traceback is not None, exc.traceback)
     
-    if data[-1] is None:
-        post_error('Phase information has to be present in the PROCAR '
-            'file. Please repeat the calculation with LORBIT=12.', True)
     
-    phases = np.copy(data[-1])
+def run_batch(args, options, profiler):
+    '''Unfolds the jobs of the batch manifest with the options
+    given on the command line. Failed jobs are reported and the 
+    remaining jobs are still unfolded. Jobs unfolded by worker
+    processes are not recorded by the profiler.
+    '''
+    jobs = parse_batch(args.batch)
     
-    norbs = phases.shape[1]/len(spos)
+    for job in jobs:
+        job.setdefault('tgen', args.tgen)
+        
+        if job.get('procar'):
+            job.setdefault('out', strip_compression(job['procar']))
     
-    projs = build_projectors(irreps, ops, norbs)
+    def open_writers(job, nirreps, ntotal):
+        return open_outputs(args, job['out'], job['procar'], nirreps, 
+            ntotal)
     
-    if args.out is None:
-        output = args.procar
-    else:
-        output = args.out
+    failures = unfold_batch(open_writers, jobs, args.jobs, **options)
+    
+    for job, exc in zip(jobs, failures):
+        if exc is not None:
+            sys.stderr.write('\nError in job "{0}": {1}\n'.format(
+                job.get('procar'), exc))
     
-    if args.all_irreps:
-        nirrep = len(projs)
+    if args.profile:
+        write_profile(profiler, args.outputs, args.batch+'.profile.json')
+    
+    nfailed = len(failures)-failures.count(None)
+    
+    if nfailed:
+        raise UnfoldingError('{0} of {1} jobs failed.'.format(nfailed, 
+            len(jobs)))
+    
+    
+def open_outputs(args, output, procar, nirreps, ntotal):
+    '''Opens the writers for the first nirreps of ntotal irreps 
+    of the PROCAR file in the output format specified by the 
+    command line arguments.
+    '''
+    outs = []
+    
+    # Text output is compressed as the input unless specified
+    if args.compress is None:
+        ext = compression(procar) or ''
+    elif args.compress == 'none':
+        ext = ''
     else:
-        nirrep = 1
-        
-    for i, p in enumerate(projs[:nirrep]):
-        for s in xrange(data[-1].shape[-1]):
+        ext = '.'+args.compress
+    
+    try:
+        for i in xrange(nirreps):
+            fname = '{0}.irrep.{1}'.format(output, i)
+            
+            if args.format == 'procar':
+                fname += ext
+            
+            args.outputs.append(fname)
+            
             try:
-                data[-1][:,:,:,s] = np.dot(p, phases[:,:,:,s]).swapaxes(0, 1)
-            except:
-                post_error('Unable to apply projectors. Are you sure '
-                    'that specified POSCAR and PROCAR file belong to '
-                    'the same crystal structure?')
-        
-        # We update total absolute weights to correspond to
-        # unfolded phases (by multiplying them by the magnitude
-        # ratio of unfolded and folded phases 
-        phase_ratio = np.abs(data[-1])/(np.abs(phases)+1e-4)
-        
-        for idim in xrange(data[-2].shape[3]):
-            data[-2][:,:,:,idim,:] *= phase_ratio
-
-        write_procar('{0}.irrep.{1}'.format(output, i), *data)
+                if args.format == 'npy':
+                    outs.append(NpyWriter(fname, {'irrep': i, 
+                        'nirreps': ntotal, 
+                        'source': os.path.abspath(procar)}))
+                else:
+                    outs.append(ProcarWriter(fname))
+            except (IOError, OSError):
+                raise OutputError('Unable to open "{0}" for writing'.format(
+                    fname))
+    except UnfoldingError:
+        # Outputs opened so far are closed
+        for out in outs:
+            out.close()
+        
+        raise
+    
+    # Spectral function is computed from the blocks of irrep 0
+    if args.spectral is not None:
+        spectral = SpectralWriter(output, args.spectral, args.broadening,
+            args.smearing)
+        
+        args.outputs.extend(spectral.path(s) for s in xrange(2))
+        
+        outs[0] = MultiWriter([outs[0], spectral])
+    
+    return outs
        
        
+def write_profile(profiler, outputs, fname):
+    '''Writes the profiler report to the JSON file, counting
+    the bytes written to the outputs which exist.
+    '''
+    for output in outputs:
+        if os.path.exists(output):
+            profiler.count('bytes_written', entry_size(output))
+    
+    try:
+        profiler.dump(fname)
+    except (IOError, OSError):
+        raise OutputError('Unable to write the profile report to '
+            '"{0}"'.format(fname))
+    
+    
 if __name__ == '__main__':
     main()
     
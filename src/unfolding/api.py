@@ -0,0 +1,528 @@
+#===========================================================
+#
+#  PROJECT: vasp_unfold
+#  FILE:    api.py
+#  VERSION: 1.5
+#  DATE:    October 17th 2026
+#
+#===========================================================
+
+import os
+import shutil
+import tempfile
+import hashlib
+import collections
+import multiprocessing
+import numpy as np
+from utils import translation, version
+from unfolding import build_translations, build_operators, build_gathers
+from unfolding import unfold_block, select_orbits
+from parse import parse_poscar, iter_procar, load_npy, select_block
+from write import NpyWriter, ArrayWriter
+from cache import iter_cached_procar, cache_entry, cached_operators
+from parallel import iter_unfolded, WriterPool
+from profiler import Profiler
+from errors import UnfoldingError, InputError, ParseError
+from errors import unfolding_errors, projection_errors
+import errors
+
+
+def unfold(poscar, procar, tgens, all_irreps=False, **kwargs):
+    '''Unfolds the bands of the PROCAR file within the current
+    process. Translation generators are given either as strings
+    such as "1/2,0,0", or as lists of three fractions. Returns
+    a list with the data list of every irrep, holding the same
+    arrays as returned by parse_procar. Other arguments are
+    passed to unfold_into. Raises UnfoldingError on failure.
+    '''
+    def open_outputs(nirreps, ntotal):
+        return [ArrayWriter() for i in xrange(nirreps)]
+    
+    outs = unfold_into(open_outputs, poscar, procar, tgens, all_irreps,
+        **kwargs)
+    
+    return [out.data for out in outs]
+    
+    
+class Supercell(object):
+    '''Supercell structure from the POSCAR file together with 
+    the fractional translations generated by the generators. 
+    Translation operators are built once, and gathers once for
+    every number of orbitals per atom, so that they are shared 
+    by all PROCAR files calculated for the same structure.
+    '''
+    
+    def __init__(self, poscar, tgens, check_mapping=False, eps=1e-6,
+                 cache_dir=None, cache_size=10*2**30, profiler=None):
+        '''Constructor parses the POSCAR file and builds the
+        translation operators. Generators are given either as 
+        strings such as "1/2,0,0", or as lists of three fractions.
+        If cache_dir is given, operators are loaded from it or
+        stored into it, keeping it below cache_size bytes. Stages
+        of the setup are recorded by the profiler, if given.
+        '''
+        if not tgens:
+            raise InputError('At least one translation generator has to '
+                'be specified.')
+        
+        self.profiler = profiler or Profiler(False)
+        
+        self.tgens = [translation(t) if isinstance(t, basestring) else t
+            for t in tgens]
+        
+        with self.profiler.stage('build_translations'):
+            self.trans, self.irreps, self.order = build_translations(
+                self.tgens)
+        
+        try:
+            with self.profiler.stage('parse_poscar'):
+                cell, self.spos, self.symbols = parse_poscar(poscar)
+        except UnfoldingError:
+            raise
+        except Exception:
+            raise ParseError('Unable to parse the input POSCAR file. Please '
+                'check if the file exists and is formatted properly.', True)
+        
+        with self.profiler.stage('build_operators'):
+            if cache_dir is None:
+                self.ops = build_operators(self.spos, self.trans, 
+                    check_mapping, eps)
+            else:
+                self.ops = cached_operators(cache_dir, cache_size, self.spos, 
+                    self.trans, check_mapping, eps)
+        
+        self.gathers = {}
+    
+    
+    def select_atoms(self, selection):
+        '''Returns the sorted array of indices of the selected
+        atoms. Atoms are selected by their indices or chemical
+        symbols. If selection is None, all atoms are selected.
+        '''
+        natoms = len(self.spos)
+        
+        if selection is None:
+            return np.arange(natoms)
+        
+        atoms = []
+        
+        for item in selection:
+            if item in self.symbols:
+                atoms += [i for i, s in enumerate(self.symbols) if s == item]
+            elif isinstance(item, (int, long)) and 0 <= item < natoms:
+                atoms.append(item)
+            elif isinstance(item, (int, long)):
+                raise InputError('There is no atom number {0} in the POSCAR '
+                    'file, which has {1} atoms.'.format(item+1, natoms))
+            else:
+                raise InputError('There are no "{0}" atoms in the POSCAR '
+                    'file, which has atoms of {1}.'.format(item,
+                    ', '.join(sorted(set(self.symbols)))))
+        
+        if not atoms:
+            raise InputError('No atoms are selected.')
+        
+        return np.unique(atoms)
+    
+    
+    def get_gathers(self, norbs, atoms=None):
+        '''Returns the gathers for norbs orbitals per atom. If 
+        the atoms are given, gathers unfold only them and take
+        the phase rows of the atoms returned by select_orbits.
+        '''
+        key = norbs if atoms is None else (norbs, tuple(atoms))
+        
+        if key not in self.gathers:
+            # Translations are applied as row permutations
+            # of the phase array instead of dense projectors
+            with self.profiler.stage('build_gathers'):
+                if atoms is None:
+                    perms = self.ops
+                else:
+                    perms = select_orbits(self.ops, atoms)[1]
+        
+                self.gathers[key] = build_gathers(perms, norbs)
+        
+        return self.gathers[key]
+    
+    
+def unfold_into(open_outputs, poscar, procar, tgens, all_irreps=False,
+                eps=1e-6, check_mapping=False, operators_cache=None, 
+                **kwargs):
+    '''Unfolds the bands of the PROCAR file and writes the irreps
+    through the writers returned by open_outputs(nirreps, ntotal).
+    Translation operators are cached in operators_cache directory
+    if it is given. Other arguments are passed to unfold_supercell.
+    Returns the closed writers. Raises UnfoldingError on failure.
+    '''
+    supercell = Supercell(poscar, tgens, check_mapping, eps, 
+        operators_cache, kwargs.get('cache_size', 10*2**30), 
+        kwargs.get('profiler'))
+    
+    return unfold_supercell(open_outputs, supercell, procar, all_irreps, 
+        **kwargs)
+    
+    
+def unfold_supercell(open_outputs, supercell, procar, all_irreps=False,
+                     vasp_version=(5, 2, 2), chunk=64, dtype=float, 
+                     cache_dir=None, cache_size=10*2**30, jobs=1, writers=1,
+                     max_irreps=None, text=False, workdir=None, 
+                     profiler=None, atoms=None, orbitals=None):
+    '''Unfolds the bands of the PROCAR file calculated for the
+    supercell and writes the irreps through the writers returned
+    by open_outputs(nirreps, ntotal), which is called once the
+    first block of k-points is parsed. Only the first irrep is
+    written unless all_irreps is True. Writers are given the 
+    blocks of k-points by their write method, or by write_text
+    if text is True and jobs > 1. Other arguments have the same
+    meaning as the command line options, with cache_size given
+    in bytes. Parsed data is stored in workdir for the worker
+    processes if cache_dir is not given. Parsing, projection and
+    writing of every irrep are recorded by the profiler, if given.
+    If atoms (indices or chemical symbols) or orbitals (labels,
+    indices or groups s, p, d and f) are given, only their
+    weights and phases, and of the atoms in their translation
+    orbits, are parsed and projected, and only theirs are 
+    written. Returns the closed writers. Raises UnfoldingError
+    on failure.
+    '''
+    if profiler is None:
+        profiler = Profiler(False)
+    
+    if isinstance(vasp_version, basestring):
+        vasp_version = version(vasp_version)
+    
+    if chunk < 1:
+        raise InputError('Chunk size must be a positive number of k-points.')
+    
+    if jobs < 1:
+        raise InputError('Number of jobs must be positive.')
+    
+    if writers < 1:
+        raise InputError('Number of writers must be positive.')
+    
+    if max_irreps is None:
+        max_irreps = 2*writers
+    elif max_irreps < 1:
+        raise InputError('Maximal number of irreps in memory must be '
+            'positive.')
+    
+    irreps = supercell.irreps
+    order = supercell.order
+    
+    # Number of irreps written to the output
+    nirreps = len(irreps) if all_irreps else 1
+    
+    # Orders of the generators are only needed to
+    # project phases onto all irreps at once
+    if not all_irreps:
+        order = None
+    
+    # Only the atoms in translation orbits of the selected
+    # atoms are needed to unfold them
+    if atoms is None and orbitals is None:
+        selected = ions = None
+    else:
+        selected = supercell.select_atoms(atoms)
+        ions = select_orbits(supercell.ops, selected)[0]
+    
+    # PROCAR is processed in blocks of k-points, so that
+    # the memory used does not depend on the number of
+    # k-points in the file
+    if cache_dir is None:
+        blocks = iter_procar(procar, vasp_version, chunk, dtype=dtype,
+            ions=ions, orbitals=orbitals)
+    else:
+        blocks = iter_cached_procar(cache_dir, cache_size, procar,
+            vasp_version, chunk, dtype=dtype)
+        
+        # Cache holds all atoms and orbitals
+        if selected is not None:
+            blocks = iter_selected(blocks, ions, orbitals)
+    
+    # This function checks the first parsed block and sets up
+    # the gathers and the output writers based on it
+    def setup(data):
+        if data[-1] is None:
+            raise InputError('Phase information has to be present in the '
+                'PROCAR file. Please repeat the calculation with '
+                'LORBIT=12.')
+        
+        if selected is None:
+            norbs = data[-1].shape[1]/len(supercell.spos)
+        else:
+            norbs = len(data[0])
+        
+        gathers = supercell.get_gathers(norbs, selected)
+        
+        outs = open_outputs(nirreps, len(irreps))
+        
+        # Irreps are written concurrently by writer threads
+        return gathers, WriterPool(outs, writers, max_irreps, profiler)
+    
+    # Temporary directory for the parsed data in parallel mode
+    tempdir = None
+    
+    pool = None
+    
+    try:
+        if jobs > 1:
+            # Workers map parsed data stored in binary form,
+            # either in the cache or in a temporary directory
+            with unfolding_errors(ParseError, errors.poscar_parse_error,
+                    'Unable to store the parsed PROCAR file.'):
+                if cache_dir is not None and selected is None:
+                    dirname = cache_entry(cache_dir, procar, vasp_version,
+                        dtype)
+                    
+                    # Parsing stores the file into the cache
+                    if not os.path.isdir(dirname):
+                        with profiler.stage('parse_procar'):
+                            for block in blocks:
+                                pass
+                else:
+                    tempdir = tempfile.mkdtemp(prefix='.vasp_unfold.',
+                        dir=workdir)
+                    
+                    dirname = tempdir
+                    
+                    writer = NpyWriter(tempdir)
+                    
+                    try:
+                        with profiler.stage('parse_procar'):
+                            for block in blocks:
+                                writer.write(*block)
+                        
+                            writer.close()
+                    finally:
+                        # Memory maps are released also if parsing fails
+                        writer = None
+                
+                data = load_npy(dirname)[0]
+            
+            gathers, pool = setup(data)
+            
+            del data
+            
+            unfolded = iter_unfolded(dirname, gathers, irreps, order, chunk,
+                jobs, text)
+            
+            with projection_errors():
+                while True:
+                    # Projection is done by the workers, so this
+                    # is the time spent waiting for the results
+                    with profiler.stage('projection'):
+                        try:
+                            block = next(unfolded)
+                        except StopIteration:
+                            break
+                    
+                    s, first, npoints, nspin, results = block
+                    
+                    for i, r in enumerate(results):
+                        if text:
+                            pool.submit(i, 'write_text', r)
+                        else:
+                            pool.submit(i, 'write', s, first, npoints,
+                                nspin, r)
+        else:
+            # Output writers are opened once the first block is parsed
+            while True:
+                try:
+                    with profiler.stage('parse_procar'):
+                        s, first, npoints, nspin, data = next(blocks)
+                except StopIteration:
+                    break
+                except UnfoldingError:
+                    raise
+                except Exception:
+                    raise ParseError(errors.poscar_parse_error, True)
+                
+                if pool is None:
+                    gathers, pool = setup(data)
+                
+                with projection_errors():
+                    # Irreps are unfolded one at a time and dropped
+                    # once submitted, so only the blocks waiting to
+                    # be written are kept. Rescaled weights of every
+                    # irrep are obtained by the writers
+                    unfolded = unfold_block(data, gathers, irreps, order)
+                    
+                    i = 0
+                    
+                    while True:
+                        with profiler.stage('projection'):
+                            try:
+                                d = next(unfolded)
+                            except StopIteration:
+                                break
+                        
+                        pool.submit(i, 'write', s, first, npoints, nspin, d)
+                        
+                        del d
+                        
+                        i += 1
+        
+        if pool is None:
+            raise ParseError(errors.poscar_parse_error)
+        
+        with projection_errors():
+            pool.close()
+    finally:
+        # Nothing is left behind if the call fails, so that
+        # it can be repeated within the same process. Writers
+        # which are still open are closed
+        blocks.close()
+        
+        if pool is not None:
+            pool.abort()
+        
+        if tempdir is not None:
+            shutil.rmtree(tempdir, ignore_errors=True)
+    
+    profiler.count('kpoints', npoints*(s+1))
+    profiler.count('bytes_read', os.path.getsize(procar))
+    
+    return pool.outs
+    
+    
+def iter_selected(blocks, ions, orbitals):
+    '''Generator which restricts the blocks of k-points to the
+    given ions and orbitals with select_block.
+    '''
+    try:
+        for s, i, npoints, nspin, data in blocks:
+            yield s, i, npoints, nspin, select_block(data, ions, orbitals)
+    finally:
+        blocks.close()
+
+    
+# State of the batch worker processes, which inherit it
+# as the workers of parallel.py inherit parallel.state
+batch_state = {}
+    
+    
+def batch_key(job):
+    '''Returns the key grouping the jobs of a batch. Jobs have
+    the same key if their POSCAR files have the same contents
+    and their translation generators are the same.
+    '''
+    for key in ('poscar', 'procar'):
+        if key not in job:
+            raise InputError('Job has no "{0}" entry.'.format(key))
+    
+    # Generators are missing if neither the job nor --tgen gives them
+    if not isinstance(job.get('tgen'), (list, tuple)) or not job['tgen']:
+        raise InputError('Job has no translation generators.')
+    
+    try:
+        with open(job['poscar'], 'rb') as f:
+            structure = hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        raise ParseError('Unable to open "{0}" for reading.'.format(
+            job['poscar']))
+    
+    tgens = tuple(tuple(translation(t) if isinstance(t, basestring) else t)
+        for t in job['tgen'])
+    
+    return structure, tgens
+    
+    
+def run_job(open_outputs, supercell, job, kwargs):
+    '''Unfolds the PROCAR file of the job. Returns None if
+    it succeeds, otherwise the UnfoldingError raised.
+    '''
+    def open_writers(nirreps, ntotal):
+        return open_outputs(job, nirreps, ntotal)
+    
+    # Version of VASP may be given for every job
+    if 'vasp_version' in job:
+        kwargs = dict(kwargs, vasp_version=job['vasp_version'])
+    
+    try:
+        unfold_supercell(open_writers, supercell, job['procar'], **kwargs)
+    except UnfoldingError as exc:
+        return exc
+    
+    return None
+    
+    
+def unfold_job(i):
+    '''Unfolds i-th job of the batch in the worker process
+    '''
+    return run_job(batch_state['open_outputs'], batch_state['supercell'],
+        batch_state['jobs'][i], batch_state['kwargs'])
+    
+    
+def unfold_batch(open_outputs, jobs, nprocs=1, eps=1e-6, 
+                 check_mapping=False, operators_cache=None, **kwargs):
+    '''Unfolds a batch of jobs. Every job is a dictionary with
+    the locations of POSCAR and PROCAR files under "poscar" and
+    "procar", translation generators under "tgen" and optionally 
+    the version of VASP under "vasp_version". Jobs with the same
+    structure and generators are grouped, so that the supercell
+    is set up once for every group, and translation operators 
+    are cached in operators_cache directory if it is given. 
+    PROCAR files of a group are unfolded one after another, or 
+    by nprocs worker processes.
+    Writers of a job are returned by open_outputs(job, nirreps, 
+    ntotal). Other arguments are passed to unfold_supercell. 
+    Returns a list with None for every successful job and the 
+    UnfoldingError raised for every failed one.
+    '''
+    if nprocs < 1:
+        raise InputError('Number of jobs must be positive.')
+    
+    if nprocs > 1 and kwargs.get('jobs', 1) > 1:
+        raise InputError('PROCAR files unfolded in parallel can not use '
+            'worker processes of their own.')
+    
+    failures = [None]*len(jobs)
+    
+    # Groups are processed in the order of their first job
+    groups = collections.OrderedDict()
+    
+    for i, job in enumerate(jobs):
+        try:
+            groups.setdefault(batch_key(job), []).append(i)
+        except UnfoldingError as exc:
+            failures[i] = exc
+    
+    for indices in groups.values():
+        job = jobs[indices[0]]
+        
+        try:
+            supercell = Supercell(job['poscar'], job['tgen'], check_mapping, 
+                eps, operators_cache, kwargs.get('cache_size', 10*2**30), 
+                kwargs.get('profiler'))
+        except UnfoldingError as exc:
+            for i in indices:
+                failures[i] = exc
+            
+            continue
+        
+        if nprocs == 1 or len(indices) == 1:
+            for i in indices:
+                failures[i] = run_job(open_outputs, supercell, jobs[i], 
+                    kwargs)
+            
+            continue
+        
+        batch_state.clear()
+        batch_state.update(open_outputs=open_outputs, supercell=supercell,
+            jobs=jobs, kwargs=kwargs)
+        
+        pool = multiprocessing.Pool(min(nprocs, len(indices)))
+        
+        try:
+            for i, exc in zip(indices, pool.map(unfold_job, indices, 1)):
+                failures[i] = exc
+            
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            
+            batch_state.clear()
+    
+    return failures
@@ -0,0 +1,299 @@
+#===========================================================
+#
+#  PROJECT: vasp_unfold
+#  FILE:    cache.py
+#  VERSION: 1.5
+#  DATE:    October 17th 2026
+#
+#===========================================================
+
+import os
+import shutil
+import time
+import hashlib
+import json
+import numpy as np
+from parse import iter_procar, load_npy
+from write import NpyWriter
+from unfolding import build_operators
+
+# Version of the cache layout. It is part of the key,
+# so entries written by other versions are never used
+cache_version = 2
+
+
+def cache_key(filename, vasp_version, dtype):
+    '''Returns the key of the cache entry for the PROCAR file.
+    Key depends on the location, size and modification time of
+    the file, its format and the precision of stored arrays.
+    '''
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    
+    key = [cache_version, path, stat.st_size, stat.st_mtime,
+           vasp_version >= (5, 4, 4), np.dtype(dtype).str]
+    
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+    
+    
+def entry_size(entry):
+    '''Returns the total size of files in the cache entry.
+    '''
+    if not os.path.isdir(entry):
+        return os.path.getsize(entry)
+    
+    size = 0
+    
+    for name in os.listdir(entry):
+        try:
+            size += os.path.getsize(os.path.join(entry, name))
+        except OSError:
+            pass
+    
+    return size
+    
+    
+def invalidate(cache_dir, info):
+    '''Removes cache entries of the same PROCAR file as described
+    by info, which were stored before the file was modified.
+    '''
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+    
+        try:
+            with open(os.path.join(entry, 'manifest.json')) as f:
+                other = json.load(f)
+    
+            if other['source'] == info['source'] and \
+               (other['size'], other['mtime']) != (info['size'], info['mtime']):
+                shutil.rmtree(entry, ignore_errors=True)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    
+    
+def remove_entry(entry):
+    '''Removes the cache entry, which is either a directory
+    or a single file.
+    '''
+    if os.path.isdir(entry):
+        shutil.rmtree(entry, ignore_errors=True)
+    else:
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+    
+    
+def evict(cache_dir, max_size, keep=None):
+    '''Removes the least recently used entries from the cache
+    directory until the total size of the cache does not exceed
+    max_size bytes. Entry named keep is never removed.
+    '''
+    entries = []
+    
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+    
+        try:
+            mtime = os.path.getmtime(entry)
+    
+            # Skip entries which are still being written, unless
+            # they were left behind by an interrupted run
+            if '.tmp' in name and time.time()-mtime < 86400:
+                continue
+    
+            entries.append((mtime, entry_size(entry), name))
+        except OSError:
+            pass
+    
+    total = sum(e[1] for e in entries)
+    
+    # Oldest entries are removed first
+    for mtime, size, name in sorted(entries):
+        if total <= max_size:
+            break
+    
+        if name != keep:
+            remove_entry(os.path.join(cache_dir, name))
+            total -= size
+    
+    
+def cache_entry(cache_dir, filename, vasp_version, dtype=float):
+    '''Returns the directory of the cache entry for the PROCAR
+    file, which exists only if the file is in the cache.
+    '''
+    return os.path.join(cache_dir, cache_key(filename, vasp_version, dtype))
+    
+    
+def load_procar(cache_dir, filename, vasp_version, dtype=float):
+    '''Loads parsed PROCAR file from the cache. Returns the
+    same list as parse_procar, with arrays mapped read-only
+    into memory, or None if the file is not in the cache.
+    '''
+    entry = cache_entry(cache_dir, filename, vasp_version, dtype)
+    
+    if not os.path.isdir(entry):
+        return None
+    
+    try:
+        data, manifest = load_npy(entry)
+        
+        # Mark the entry as recently used
+        os.utime(entry, None)
+    except (IOError, OSError, ValueError, KeyError):
+        # Remove incomplete or damaged entry
+        shutil.rmtree(entry, ignore_errors=True)
+        
+        return None
+    
+    return data
+    
+    
+def iter_cached_procar(cache_dir, max_size, filename, vasp_version,
+                       chunk=None, bufsize=2**24, dtype=float):
+    '''Generator which yields the same blocks of k-points as
+    iter_procar. If the PROCAR file is in the cache, blocks are
+    read from the cache. Otherwise the file is parsed and blocks
+    are stored into the cache as they are parsed. Cache is kept
+    below max_size bytes by removing least recently used entries.
+    '''
+    data = load_procar(cache_dir, filename, vasp_version, dtype)
+    
+    if data is not None:
+        npoints = len(data[1])
+        nspin = data[3].shape[-1]
+        
+        if chunk is None:
+            chunk = npoints
+        
+        for s in xrange(nspin):
+            for i in xrange(0, npoints, chunk):
+                # Blocks are copied, so that the mapped
+                # arrays are never modified
+                block = [data[0], np.array(data[1][i:i+chunk]),
+                    np.array(data[2][i:i+chunk])]
+                
+                for a in data[3:]:
+                    block.append(None if a is None else
+                        np.array(a[i:i+chunk,...,s]))
+                
+                yield s, i, npoints, nspin, block
+        
+        return
+    
+    key = cache_key(filename, vasp_version, dtype)
+    
+    entry = os.path.join(cache_dir, key)
+    
+    # Entry is written into a temporary directory
+    # and renamed once it is complete
+    temp = '{0}.tmp{1}'.format(entry, os.getpid())
+    
+    stat = os.stat(filename)
+    
+    info = {'source': os.path.abspath(filename), 'size': stat.st_size, 
+            'mtime': stat.st_mtime}
+    
+    try:
+        try:
+            writer = NpyWriter(temp, info)
+        except (IOError, OSError):
+            # Continue without caching
+            writer = None
+        
+        for block in iter_procar(filename, vasp_version, chunk, bufsize, 
+                dtype):
+            if writer is not None:
+                try:
+                    writer.write(*block)
+                except (IOError, OSError):
+                    writer = None
+            
+            yield block
+        
+        if writer is not None:
+            try:
+                writer.close()
+                writer = None
+                
+                os.rename(temp, entry)
+            except (IOError, OSError):
+                # Entry could not be completed, or another
+                # process has already stored it
+                pass
+            
+            if os.path.isdir(entry):
+                # Mark the entry as recently used
+                os.utime(entry, None)
+                
+                invalidate(cache_dir, info)
+                evict(cache_dir, max_size, key)
+    finally:
+        writer = None
+        
+        shutil.rmtree(temp, ignore_errors=True)
+    
+    
+def operators_key(spos, trans, check_mapping, eps):
+    '''Returns the key of the cache entry for the translation
+    operators. Key depends on the fractional positions of atoms,
+    translations, matching tolerance and whether the mapping 
+    was checked to be one-to-one.
+    '''
+    sha = hashlib.sha1(repr([cache_version, 'operators', bool(check_mapping), 
+        float(eps)]).encode())
+    
+    for a in (spos, trans):
+        sha.update(np.ascontiguousarray(a, float).tobytes())
+    
+    return sha.hexdigest()
+    
+    
+def cached_operators(cache_dir, max_size, spos, trans, check_mapping=False,
+                     eps=1e-6):
+    '''Returns the translation operators as build_operators
+    does. Operators are loaded from the cache directory if they were 
+    built before for the same positions and translations. 
+    Otherwise they are built and stored into the cache as a 
+    single .npy file. Cache is kept below max_size bytes by 
+    removing least recently used entries.
+    '''
+    name = operators_key(spos, trans, check_mapping, eps)+'.ops.npy'
+    
+    entry = os.path.join(cache_dir, name)
+    
+    try:
+        ops = np.load(entry)
+        
+        if ops.shape == (len(trans), len(spos)):
+            # Mark the entry as recently used
+            os.utime(entry, None)
+            
+            return ops.astype(int)
+    except (IOError, OSError, ValueError):
+        pass
+    
+    ops = build_operators(spos, trans, check_mapping, eps)
+    
+    # Entry is written into a temporary file
+    # and renamed once it is complete
+    temp = '{0}.tmp{1}'.format(entry, os.getpid())
+    
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        
+        with open(temp, 'wb') as f:
+            np.save(f, ops.astype(np.int32))
+        
+        os.rename(temp, entry)
+        
+        evict(cache_dir, max_size, name)
+    except (IOError, OSError):
+        # Continue without caching
+        pass
+    finally:
+        if os.path.exists(temp):
+            remove_entry(temp)
+    
+    return ops
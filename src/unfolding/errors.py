@@ -1,7 +1,7 @@
 #===========================================================
 #
 #  PROJECT: vasp_unfold
-#  FILE:    __errors__.py
+#  FILE:    errors.py
 #  AUTHOR:  Milan Tomic
 #  EMAIL:   tomic@th.physik.uni-frankfurt.de
 #  VERSION: 1.4
@@ -9,6 +9,81 @@
 #
 #===========================================================
 
+import traceback
+import contextlib
+
+
+class UnfoldingError(Exception):
+    '''Base class of the errors raised by vasp_unfold. If 
+    the error is caused by another exception, its traceback 
+    is kept in the traceback attribute, otherwise it is None.
+    '''
+    
+    def __init__(self, message, caused=False):
+        '''Constructor takes the error message. If caused is 
+        True, traceback of the exception being handled is kept.
+        '''
+        super(UnfoldingError, self).__init__(message)
+        
+        self.traceback = traceback.format_exc() if caused else None
+        
+        
+class InputError(UnfoldingError):
+    '''Invalid arguments or input missing required data
+    '''
+    
+    
+class ParseError(UnfoldingError):
+    '''Input POSCAR or PROCAR file could not be read
+    '''
+    
+    
+class SymmetryError(UnfoldingError):
+    '''Invalid translation generators or atom mapping
+    '''
+    
+    
+class ProjectionError(UnfoldingError):
+    '''Projectors could not be applied to the phases
+    '''
+    
+    
+class OutputError(UnfoldingError):
+    '''Output or temporary data could not be written
+    '''
+    
+    
+@contextlib.contextmanager
+def unfolding_errors(error, message, output_message='Unable to write the '
+                     'output.'):
+    '''Context manager which turns exceptions raised in the
+    enclosed code into UnfoldingError, keeping their traceback.
+    IOError and OSError become OutputError with output_message,
+    other exceptions become error with the message. Exceptions
+    which are already UnfoldingError are raised unchanged.
+    '''
+    try:
+        yield
+    except UnfoldingError:
+        raise
+    except (IOError, OSError):
+        raise OutputError(output_message, True)
+    except Exception:
+        raise error(message, True)
+    
+    
+def projection_errors():
+    '''Context manager which reports failures of projecting
+    and writing the unfolded blocks, as unfolding_errors.
+    '''
+    return unfolding_errors(ProjectionError, projection_error)
+    
+
+projection_error = 'Unable to apply projectors. Are you sure that specified '\
+                   'POSCAR and PROCAR file belong to the same crystal '\
+                   'structure?'
+
+
 poscar_parse_error = """Unable to parse the input PROCAR file. Please check if the 
 PROCAR file is properly formatted.
 
@@ -0,0 +1,242 @@
+#===========================================================
+#
+#  PROJECT: vasp_unfold
+#  FILE:    parallel.py
+#  VERSION: 1.5
+#  DATE:    October 17th 2026
+#
+#===========================================================
+
+import numpy as np
+import multiprocessing
+import threading
+import Queue
+from collections import deque
+from parse import load_npy
+from unfolding import unfold_block
+from write import format_kpoints
+from profiler import Profiler
+
+# State of the worker processes. It is set up before the
+# pool is created, so that the workers inherit it when
+# they are forked, instead of receiving a copy of it with
+# every task. Large arrays such as gathers are therefore
+# shared with the workers without being pickled. The pool
+# of batch jobs in api.py shares its state in the same way
+state = {}
+
+
+def unfold_chunk(s, first, nk):
+    '''Unfolds nk k-points of s-th spin component starting
+    with the first one in the worker process. Returns a list
+    with the result for every irrep, either the formatted
+    text of the PROCAR block or the data list.
+    '''
+    # Every worker maps the data into memory only once
+    if 'data' not in state:
+        state['data'] = load_npy(state['dirname'])[0]
+    
+    data = state['data']
+    
+    # Copy the slice of the mapped arrays
+    block = [data[0], np.array(data[1][first:first+nk]),
+        np.array(data[2][first:first+nk])]
+    
+    for a in data[3:]:
+        block.append(None if a is None else np.array(a[first:first+nk,...,s]))
+    
+    results = []
+    
+    for d in unfold_block(block, state['gathers'], state['irreps'],
+            state['order']):
+        if state['text']:
+            results.append(format_kpoints(first, len(data[1]), *d))
+        else:
+            results.append(list(d))
+    
+    return results
+    
+    
+def iter_unfolded(dirname, gathers, irreps, order, chunk, jobs, text):
+    '''Generator which unfolds the data stored by NpyWriter in
+    the given directory using jobs worker processes. Every
+    worker maps the data into memory and unfolds its own blocks
+    of chunk k-points, which are returned formatted as text if
+    text is True. Otherwise data lists are returned. Yields
+    (s, i, npoints, nspin, results) tuples in the same order as
+    iter_procar yields the blocks, where results holds the
+    output of unfold_chunk. At most 2*jobs blocks are in flight.
+    '''
+    data, manifest = load_npy(dirname)
+    
+    npoints = manifest['npoints']
+    nspin = manifest['nspin']
+    
+    del data
+    
+    state.clear()
+    state.update(dirname=dirname, gathers=gathers, irreps=irreps,
+        order=order, text=text)
+    
+    pool = multiprocessing.Pool(jobs)
+    
+    try:
+        pending = deque()
+    
+        for s in xrange(nspin):
+            for i in xrange(0, npoints, chunk):
+                nk = min(chunk, npoints-i)
+    
+                pending.append((s, i, pool.apply_async(unfold_chunk,
+                    (s, i, nk))))
+    
+                # Results are collected in order
+                while len(pending) >= 2*jobs:
+                    s0, i0, result = pending.popleft()
+    
+                    yield s0, i0, npoints, nspin, result.get()
+    
+        while pending:
+            s0, i0, result = pending.popleft()
+    
+            yield s0, i0, npoints, nspin, result.get()
+    
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    
+        state.clear()
+
+    
+    
+class WriterPool(object):
+    '''Writes several outputs concurrently from a pool of 
+    threads. Every output is always written by the same thread,
+    so blocks are written in the order they are submitted. At
+    most maxitems submitted blocks are held in memory waiting
+    to be written, after which submitting blocks waits. Writing
+    of every irrep is recorded by the profiler, if given.
+    '''
+    
+    def __init__(self, outs, nthreads, maxitems, profiler=None):
+        '''Constructor starts the threads for the given writers
+        '''
+        self.outs = outs
+        self.unclosed = list(outs)
+        self.profiler = profiler or Profiler(False)
+        self.slots = threading.Semaphore(maxitems)
+        self.error = None
+        
+        self.queues = [Queue.Queue() for i in xrange(nthreads)]
+        self.threads = [threading.Thread(target=self.run, args=(q,)) 
+            for q in self.queues]
+        
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+            
+            
+    def run(self, queue):
+        '''Writes blocks from the queue until None is received
+        '''
+        while True:
+            item = queue.get()
+            
+            if item is None:
+                break
+            
+            i, method, args = item
+            
+            try:
+                # After an error the remaining blocks are dropped
+                if self.error is None:
+                    with self.profiler.stage('write irrep {0}'.format(i)):
+                        getattr(self.outs[i], method)(*args)
+            except Exception as exc:
+                self.error = exc
+            finally:
+                # Written block is not kept while waiting for the
+                # next one, so its rescaled weights are released
+                item = args = None
+                
+                self.slots.release()
+                
+                
+    def stop(self):
+        '''Waits for the threads to finish the submitted blocks
+        '''
+        if self.threads:
+            for q in self.queues:
+                q.put(None)
+            
+            for t in self.threads:
+                t.join()
+            
+            self.threads = []
+            
+            
+    def check(self):
+        '''Raises the exception which occured in a thread
+        '''
+        if self.error is not None:
+            self.stop()
+            
+            raise self.error
+        
+        
+    def submit(self, i, method, *args):
+        '''Submits a call of the method of i-th writer with
+        the given arguments. Blocks if too many items wait.
+        '''
+        self.check()
+        
+        self.slots.acquire()
+        
+        self.queues[i%len(self.queues)].put((i, method, args))
+        
+        
+    def close_outs(self):
+        '''Closes every writer which is not closed yet, even if
+        some of them fail. The first error is raised once all
+        writers are closed.
+        '''
+        error = None
+        
+        while self.unclosed:
+            out = self.unclosed.pop(0)
+            
+            try:
+                out.close()
+            except Exception as exc:
+                if error is None:
+                    error = exc
+        
+        if error is not None:
+            raise error
+        
+        
+    def close(self):
+        '''Waits for all blocks to be written and closes writers.
+        Writers are closed also if writing failed, after which
+        the error is raised.
+        '''
+        try:
+            self.stop()
+            self.check()
+        finally:
+            self.close_outs()
+            
+            
+    def abort(self):
+        '''Stops the threads and closes the writers after a
+        failure, so that no files or memory maps are left open.
+        Errors of the writers are ignored, since the failure
+        is already being raised.
+        '''
+        self.stop()
+        
+        try:
+            self.close_outs()
+        except Exception:
+            pass
@@ -9,8 +9,19 @@
 #
 #===========================================================
 
+import os
+import json
 import numpy as np
-from utils import Getlines, post_error
+from utils import Getlines
+from streams import open_stream, stream_size
+from reader import LineReader
+from errors import ParseError, InputError
+
+
+# Indices of the orbitals of every angular momentum in
+# the order in which VASP writes them
+orbital_groups = {'s': [0], 'p': [1, 2, 3], 'd': [4, 5, 6, 7, 8],
+                  'f': [9, 10, 11, 12, 13, 14, 15]}
 
 def parse_poscar(filename):
     '''Parses POSCAR file. Returns 3x3 float array
@@ -22,7 +33,7 @@ def parse_poscar(filename):
     try:
         gl = Getlines(filename)
     except:
-        post_error('Unable to open "{0}" for reading.'.format(filename))
+        raise ParseError('Unable to open "{0}" for reading.'.format(filename))
     
     # Skip the comment line
     gl.readline()
@@ -63,7 +74,7 @@ def parse_poscar(filename):
     elif ctype == 'd':
         mult = np.eye(3)
     else:
-        post_error('"{0}" is unknown POSCAR option'.format(ctype))
+        raise ParseError('"{0}" is unknown POSCAR option'.format(ctype))
     
     # Allocate storage for positions
     spos = np.zeros((len(symbols), 3))
@@ -72,6 +83,8 @@ def parse_poscar(filename):
     for i in xrange(len(symbols)):
         spos[i] = np.array(gl.readline().split()[:3], float)
     
+    gl.close()
+    
     # If necessary, this will convert from
     # Cartesian to fractional coordinates
     spos = np.dot(spos, mult)
@@ -79,7 +92,367 @@ def parse_poscar(filename):
     return cell, spos, symbols
     
     
-def parse_procar(filename, vasp_version):
+def select_orbitals(selection, labels):
+    '''Returns the sorted array of indices of the selected 
+    orbitals among the orbitals with the given labels. Orbitals
+    are selected by their labels, indices or names of groups 
+    s, p, d and f. If selection is None, all orbitals are 
+    selected.
+    '''
+    if selection is None:
+        return np.arange(len(labels))
+    
+    indices = []
+    
+    for item in selection:
+        if item in labels:
+            indices.append(labels.index(item))
+        elif item in orbital_groups:
+            indices += [i for i in orbital_groups[item] if i < len(labels)]
+        elif isinstance(item, (int, long)) and 0 <= item < len(labels):
+            indices.append(item)
+        else:
+            raise InputError('Orbital "{0}" is not in the PROCAR file, '
+                'which has orbitals {1}.'.format(item, ', '.join(labels)))
+    
+    if not indices:
+        raise InputError('No orbitals are selected.')
+    
+    return np.unique(indices)
+    
+    
+class Orbitals(list):
+    '''List of the orbital labels of the parsed data. If the data
+    holds only some of the ions and orbitals of the PROCAR file,
+    ions holds the indices of the ions and columns the indices
+    of the orbitals in the file, otherwise they are None.
+    '''
+    
+    def __init__(self, labels, ions=None, columns=None):
+        super(Orbitals, self).__init__(labels)
+        
+        self.ions = ions
+        self.columns = columns
+    
+    
+def select_block(data, ions=None, orbitals=None):
+    '''Restricts the data list of a block of k-points, yielded 
+    by iter_procar, to the orbital weights and phases of the 
+    given ions and orbitals, as iter_procar does while parsing.
+    Returns the restricted data list.
+    '''
+    norbs = len(data[0])
+    
+    orbs = select_orbitals(orbitals, list(data[0]))
+    
+    if ions is None:
+        ions = np.arange(data[-2].shape[1]/norbs)
+    
+    rows = (np.asarray(ions)[:,np.newaxis]*norbs+orbs).flatten()
+    
+    orbitals = Orbitals([data[0][o] for o in orbs], list(ions), 
+        orbs.tolist())
+    
+    return [orbitals]+list(data[1:5])+[None if a is None else a[:,rows] 
+        for a in data[5:]]
+    
+    
+def iter_procar(filename, vasp_version, chunk=None, bufsize=2**24, 
+                dtype=float, ions=None, orbitals=None):
+    '''Generator which parses a PROCAR file in blocks of at most
+    chunk consecutive k-points (all k-points available in the
+    buffer if chunk is None). For every block it yields a tuple
+    (s, i, npoints, nspin, data), where s is the spin component,
+    i is the index of the first k-point in the block, npoints is
+    the total number of k-points, nspin is the number of spin
+    components estimated from the size of the file and data is
+    a list with the same elements as returned by parse_procar,
+    except that arrays hold only the k-points of the block and
+    have no spin axis. Blocks are yielded in the order of the
+    file. Blocks of the second spin component carry k-points of
+    the first one. Weights and phases are stored with the given
+    floating point dtype (float32 or float64) and its complex
+    counterpart respectively.
+    
+    If ions (sorted indices) or orbitals (as for select_orbitals)
+    are given, only the weights and phases of the selected ions
+    and orbitals are parsed, and the orbital axes of the arrays
+    hold only them, ordered as in the file.
+    
+    The file is read by LineReader in chunks of bufsize bytes.
+    Since every k-point block has the same layout, numbers in
+    the orbital weight and phase lines of all k-points within
+    the block are parsed in a single step. Compressed files are
+    decompressed by a background thread while being parsed.
+    Where the size of their contents is not known, one spin
+    component is estimated.
+    '''
+    try:
+        procar = open_stream(filename, 'rb', True)
+    except:
+        raise ParseError('Unable to open "{0}" for reading.'.format(filename))
+    
+    reader = LineReader(procar, bufsize)
+    
+    # Selection is replaced by the orbital labels of the file
+    selection = orbitals
+    
+    # Stream is closed also if the header can not be parsed
+    try:
+        # Read until the entire first band block is in the buffer
+        while True:
+            reader.fill()
+            
+            lines = [reader.get(i) for i in xrange(min(5, 
+                reader.available()))]
+            
+            # First band block starts at the fourth line and
+            # ends with the next band or k-point line
+            for e in xrange(5, reader.available()):
+                if reader.get(e)[:1] in (b'b', b'k', b'#'):
+                    break
+            else:
+                e = None
+            
+            if e is not None:
+                break
+            elif reader.eof:
+                if len(lines) < 5:
+                    raise ValueError('Unexpected end of file.')
+                
+                e = reader.available()
+                break
+        
+        # Size of the file is used to estimate the number of spins
+        fsize = stream_size(filename)
+        
+        header_1 = lines[0].decode()
+        header_2 = lines[1].split()
+        
+        npoints = int(header_2[3])
+        nbands = int(header_2[7])
+        nions = int(header_2[-1])
+        
+        # Determine the number of orbitals
+        orbitals = lines[4].decode().split()[1:-1]
+        
+        norbs = len(orbitals)
+        
+        # Selected ions and columns of the selected orbitals
+        restricted = ions is not None or selection is not None
+        
+        if ions is None:
+            ions = np.arange(nions)
+        else:
+            ions = np.asarray(ions, int)
+            
+            if len(ions) == 0 or ions[0] < 0 or ions[-1] >= nions:
+                raise InputError('Selected atoms are not in the PROCAR '
+                    'file, which has {0} ions.'.format(nions))
+        
+        orbs = select_orbitals(selection, orbitals)
+        
+        # Selected ions and orbitals are kept with the labels
+        if restricted:
+            orbitals = Orbitals([orbitals[o] for o in orbs], ions.tolist(),
+                orbs.tolist())
+        
+        nsel = len(ions)
+        
+        # Columns of the selected orbitals, after the ion index
+        if len(orbs) == norbs:
+            cols = slice(1, norbs+1)
+        else:
+            cols = 1+orbs
+        
+        # Determine if the calculation was non-collinear
+        # by counting how many lines in the first band
+        # block begin with tot. That number will be equal
+        # to the number of sub-blocks for orbital weights
+        # (1 in case of collinear and 4 otherwise)
+        dim = sum(reader.get(i).startswith(b'tot') for i in xrange(5, e))
+        
+        # Line offsets of orbital weight rows within the band
+        # block. Block starts with the band line followed by the
+        # line with the orbital names, after which every weight 
+        # sub-block is followed by the line with totals
+        wrows = [2+d*(nions+1)+ions for d in xrange(dim)]
+        wrows = np.concatenate(wrows)
+        
+        nlines = 2+dim*(nions+1)
+        
+        # Check whether phase information is included
+        if '+ phase' in header_1:
+            if vasp_version < (5, 4, 4):
+                # Line with orbital names is followed by
+                # rows of real and imaginary parts
+                prows = nlines+1+(2*ions[:,np.newaxis]+[0, 1]).flatten()
+                
+                nlines += 1+2*nions
+            else:
+                # Line with orbital names is followed by rows
+                # of real and imaginary parts of all orbitals
+                # and the line with charges
+                prows = nlines+1+ions
+                
+                nlines += 2+nions
+        else:
+            prows = None
+        
+        if e-3 != nlines:
+            raise ValueError('Unexpected number of lines in the band block.')
+        
+        # Line offsets of band lines within the k-point block
+        brows = 1+nlines*np.arange(nbands)
+        
+        # Number of lines per k-point block
+        kplines = 1+nbands*nlines
+        
+        # Since all band blocks have the same layout, the size
+        # of a spin component is estimated from the sizes of 
+        # the header and the first band block. If the file is
+        # considerably larger, second spin component follows
+        spin_size = reader.tell(2)+npoints*(reader.tell(3)-reader.tell(2)+
+            nbands*(reader.tell(e)-reader.tell(3)))
+        
+        nspin = 2 if fsize is not None and fsize > 1.5*spin_size else 1
+        
+        cdtype = np.result_type(dtype, np.complex64)
+        
+        # K-points of the first spin component. Second spin
+        # component repeats the same k-points
+        kpoints = np.zeros((npoints, 3), float)
+        kweights = np.zeros(npoints, float)
+        
+        # This function parses nk consecutive k-point blocks
+        # starting at the next unread line, which hold i-th
+        # and following k-points of s-th spin component
+        def get_kpoints(nk, i, s):
+            bands = np.zeros((nk, nbands), float)
+            occupancies = np.zeros((nk, nbands), float)
+            
+            for n in xrange(nk):
+                k0 = n*kplines
+                
+                # Parse k-point coordinates
+                if s == 0:
+                    k_line = reader.get(k0).split()
+                    
+                    kpoints[i+n] = [float(k_line[c]) for c in [3, 4, 5]]
+                    kweights[i+n] = float(k_line[-1])
+                
+                for j in xrange(nbands):
+                    # Parse band energy
+                    b0 = k0+brows[j]
+                    band_line = reader.get(b0).split()
+                    
+                    bands[n, j] = float(band_line[4])
+                    occupancies[n, j] = float(band_line[-1])
+            
+            # Parse all orbital weight rows at once
+            krows = kplines*np.arange(nk)[:,np.newaxis,np.newaxis]
+            
+            rows = (krows+brows[:,np.newaxis]+wrows).flatten()
+            
+            data = reader.parse(rows)
+            
+            if len(data) != nk*nbands*dim*nsel*(norbs+2):
+                raise ValueError('Unable to parse orbital weights.')
+            
+            # Cast it into tabular shape, keep the columns
+            # of the selected orbitals and reorder weights
+            w = data.reshape((nk, nbands, dim, nsel, norbs+2))
+            w = w[:,:,:,:,cols].transpose((0, 3, 4, 1, 2))
+            
+            weights = w.reshape((nk, nsel*len(orbs), nbands, dim)).astype(
+                dtype, copy=False)
+            
+            if prows is None:
+                return [orbitals, kpoints[i:i+nk], kweights[i:i+nk], bands, \
+                    occupancies, weights, None]
+            
+            # Parse all phase rows at once
+            rows = (krows+brows[:,np.newaxis]+prows).flatten()
+            
+            data = reader.parse(rows)
+            
+            if vasp_version < (5, 4, 4):
+                if len(data) != nk*nbands*2*nsel*(norbs+1):
+                    raise ValueError('Unable to parse phases.')
+                
+                # Discard first column. Real and imaginary parts
+                # are in alternating rows
+                p = data.reshape((nk, nbands, nsel, 2, norbs+1))
+                
+                re = p[:,:,:,0,cols]
+                im = p[:,:,:,1,cols]
+            else:
+                if len(data) != nk*nbands*nsel*(2*norbs+2):
+                    raise ValueError('Unable to parse phases.')
+                
+                # Discard first and last column. Real and imaginary
+                # parts are in alternating columns
+                p = data.reshape((nk, nbands, nsel, 2*norbs+2))
+                
+                re = p[:,:,:,2*orbs+1]
+                im = p[:,:,:,2*orbs+2]
+            
+            phases = np.empty((nk, nsel*len(orbs), nbands), cdtype)
+            
+            phases.real = re.transpose((0, 2, 3, 1)).reshape(phases.shape)
+            phases.imag = im.transpose((0, 2, 3, 1)).reshape(phases.shape)
+            
+            return [orbitals, kpoints[i:i+nk], kweights[i:i+nk], bands, \
+                occupancies, weights, phases]
+        
+        # Number of k-points of the current spin parsed so far
+        done = 0
+        
+        # Current spin component. K-point blocks follow
+        # after the two header lines
+        s = 0
+        
+        reader.skip(2)
+        
+        while True:
+            # Parse complete k-point blocks in the buffer
+            nk = min(reader.available()//kplines, npoints-done)
+            
+            if chunk is not None:
+                nk = min(nk, chunk)
+            
+            if nk > 0:
+                yield s, done, npoints, nspin, get_kpoints(nk, done, s)
+                
+                done += nk
+                reader.line += nk*kplines
+                
+                # There might be more complete blocks
+                if chunk is not None and done < npoints:
+                    continue
+            
+            if done == npoints:
+                if s == 1:
+                    break
+                elif reader.available() > 0:
+                    # Second spin component follows after
+                    # the line with the sizes
+                    s = 1
+                    reader.line += 1
+                    done = 0
+                    continue
+                elif reader.eof:
+                    break
+            elif reader.eof:
+                raise ValueError('Unexpected end of file.')
+            
+            # Keep the unparsed lines and read more
+            reader.fill()
+    finally:
+        reader.close()
+    
+    
+def parse_procar(filename, vasp_version, bufsize=2**24, dtype=float):
     '''This function parses a PROCAR file. It returns a tuple
     consisting of following elements:
     
@@ -101,182 +474,112 @@ def parse_procar(filename, vasp_version):
     nspin   - number of spins (1 for non spin-polarized, 2 otherwise)
     nions   - number of atoms
     ndim    - orbital weight dimensionality (1 for collinear, 4 otherwise)
-    '''
-
-    try:
-        gl = Getlines(filename)
-    except:
-        post_error('Unable to open "{0}" for reading.'.format(filename))
-
-    header_1 = gl.readline()
-    header_2 = gl.readline().split()
-    
-    npoints = int(header_2[3])
-    nbands = int(header_2[7])
-    nions = int(header_2[-1])
-    
-    # Remember the position in file
-    start = gl.tell()
     
-    # Skip two lines containing first k-point and band
-    gl.readline()
-    gl.readline()
+    Blocks of k-points produced by iter_procar are assembled
+    into the arrays for the entire file. Weights and phases are
+    stored with the given floating point dtype (float32 or
+    float64) and its complex counterpart respectively.
+    '''
+    result = None
     
-    # Determine the number of orbitals
-    orbitals = gl.readline().split()[1:-1]
-    
-    norbs = len(orbitals)
-    
-    # Allocate maximal storage. In case calculation was
-    # non spin-polarized or collinear we can just trim
-    # the excess components at the end
-    kpoints = np.zeros((npoints, 3), float)
-    kweights = np.zeros(npoints, float)
-    bands = np.zeros((npoints, nbands, 2), float)
-    occupancies = np.zeros((npoints, nbands, 2), float)
-    weights = np.zeros((npoints, nions*norbs, nbands, 4, 2), float)
-    
-    dim = 0
-    
-    # Determine if the calculation was non-collinear
-    # by counting how many lines in the first band
-    # block begin with tot. That number will be equal
-    # to the number of sub-blocks for orbital weights
-    # (1 in case of collinear and 4 otherwise)
-    while True:
-        line = gl.readline()
-        
-        if line.startswith('tot'):
-            dim += 1
-        elif line.startswith('band'):
-            break
-    
-    # This function will read block of absolute weights
-    # for i-th k-point, j-th band and s-th spin component
-    def get_absweights(i, j, s):
-        # Skip line with orbital names        
-        gl.readline()
-        
-        for k in xrange(dim):
-            # Fetch entire orbital weight block
-            data = np.fromfile(gl, sep=" ", count=nions*(norbs+2))
-            
-            # Cast it into tabular shape
-            data = data.reshape((nions, norbs+2))
-            
-            # Discard first and last columns and store weights
-            weights[i,:,j,k,s] = data[:,1:-1].flatten()
+    for s, i, npoints, nspin, block in iter_procar(filename, 
+            vasp_version, bufsize=bufsize, dtype=dtype):
+        nk = len(block[1])
+        
+        if result is None:
+            # Allocate storage for the estimated number of spins
+            nalloc = nspin
             
-            # Skip line with the totals
-            gl.readline()
+            result = [block[0], np.zeros((npoints, 3), float),
+                np.zeros(npoints, float)]
             
-    # Check whether phase information is included
-    if '+ phase' in header_1:
-        # Allocate storage for phases
-        phases = np.zeros((npoints, nions*norbs, nbands, 2), complex)
-        
-        if vasp_version < (5, 4, 4):
-            # Declare nested function that handles 
-            # parsing of complex weights
-            def get_weights(i, j, s):
-                # Read abs values of weights
-                get_absweights(i, j, s)
-                
-                # Skip line with orbital names
-                gl.readline()
-                
-                # Fetch entire phase block
-                data = np.fromfile(gl, sep=" ", count=2*nions*(norbs+1))
-                # Cast it into tabular shape
-                data = data.reshape((2*nions, norbs+1))
-
-                # Discard first column and store real and imaginary
-                # parts respectively
-                phases[i,:,j,s] =  data[::2,1:].flatten()
-                phases[i,:,j,s] += 1j*data[1::2,1:].flatten()
-        else:
-            # Declare nested function that handles 
-            # parsing of complex weights
-            def get_weights(i, j, s):
-                # Read abs values of weights
-                get_absweights(i, j, s)
-                
-                # Skip line with orbital names
-                gl.readline()
-                
-                # Fetch entire phase block
-                data = np.fromfile(gl, sep=" ", count=nions*(2*norbs+2))
-                # Cast it into tabular shape
-                data = data.reshape((nions, 2*norbs+2))
-
-                # Discard first column and store real and imaginary
-                # parts respectively
-                phases[i,:,j,s] =  data[:,1:-1:2].flatten()
-                phases[i,:,j,s] += 1j*data[:,2:-1:2].flatten()
+            for b in block[3:]:
+                if b is not None:
+                    b = np.zeros((npoints,)+b.shape[1:]+(nalloc,), b.dtype)
                 
-                # Skip line with charges
-                gl.readline()
-    else:
-        # Phases are None in this case
-        phases = None
+                result.append(b)
         
-        # In this case we just have absolutes of weights
-        # No need for a new function
-        get_weights = get_absweights
-    
-    # Go back to the beginning of the first k-point
-    gl.seek(start)
-    
-    for i in xrange(npoints):
-        # Parse k-point coordinates
-        k_line = gl.readline().split()
+        if s == nalloc:
+            # Estimate was wrong, add the second spin component
+            nalloc = 2
+            
+            result[3:] = [None if r is None else 
+                np.concatenate((r, np.zeros_like(r)), axis=-1)
+                for r in result[3:]]
         
-        kpoints[i] = [float(k_line[c]) for c in [3, 4, 5]]
-        kweights[i] = float(k_line[-1])
+        # Second spin component repeats the same k-points
+        if s == 0:
+            result[1][i:i+nk] = block[1]
+            result[2][i:i+nk] = block[2]
         
-        for j in xrange(nbands):
-            # Parse band energy
-            band_line = gl.readline().split()
-            
-            bands[i, j, 0] = float(band_line[4])
-            occupancies[i, j, 0] = float(band_line[-1])
+        for r, b in zip(result[3:], block[3:]):
+            if b is not None:
+                r[i:i+nk,...,s] = b
+    
+    # Estimate was wrong, there is no second spin component
+    if s < nalloc-1:
+        result[3:] = [None if r is None else np.copy(r[...,:1])
+            for r in result[3:]]
+    
+    return result
+    
+    
+def load_npy(dirname, mmap_mode='r'):
+    '''Loads the directory written by NpyWriter. Returns the
+    same list as parse_procar, with arrays memory mapped in the 
+    given mode, and the manifest as a dictionary.
+    '''
+    with open(os.path.join(dirname, 'manifest.json')) as f:
+        manifest = json.load(f)
+    
+    data = [Orbitals(manifest['orbitals'], manifest.get('ions'), 
+        manifest.get('columns'))]
+    
+    for name in ['kpoints', 'kweights', 'bands', 'occupancies',
+                 'weights', 'phases']:
+        if name in manifest['arrays']:
+            a = manifest['arrays'][name]
             
-            # Parse orbital weights
-            get_weights(i, j, 0)
-    
-    # Seek now for the second spin component
-    res = gl.readline(False)
-    
-    # If there is no second spin component, finish by
-    # returning just the first component
-    if res is None:
-        # Trim the second spin component
-        bands = bands[:,:,:1]
-        occupancies = occupancies[:,:,:1]
-        weights = weights[:,:,:,:dim,:1]
-        
-        if phases is not None:
-            phases = phases[:,:,:,:1]
-        
-        return [orbitals, kpoints, kweights, bands, occupancies, \
-            weights, phases]
-    
-    # Otherwise, read bands and weights for the second component
-    for i in xrange(npoints):
-        # Skip k-point coordinates
-        gl.readline()
-        
-        for j in xrange(nbands):
-            # Parse band energy
-            band_line = gl.readline().split()
-
-            bands[i, j, 1] = float(band_line[4])
-            occupancies[i, j, 1] = float(band_line[-1])
+            data.append(np.load(os.path.join(dirname, a['file']), 
+                mmap_mode=mmap_mode))
             
-            # Parse orbital weights
-            get_weights(i, j, 1)
+            if list(data[-1].shape) != a['shape']:
+                raise ValueError('Array {0} does not match the '
+                    'manifest.'.format(name))
+        else:
+            data.append(None)
     
-    return [orbitals, kpoints, kweights, bands, occupancies, \
-        weights[:,:,:,:dim,:], phases]
-
+    return data, manifest
 
+    
+def parse_batch(filename):
+    '''Parses JSON manifest of a batch of unfolding jobs. It
+    holds a list of jobs, each an object with the locations of
+    POSCAR and PROCAR files under "poscar" and "procar", and 
+    optionally translation generators under "tgen" as a list of 
+    strings, output prefix under "out" and version of VASP 
+    under "vasp_version". Relative locations are resolved with
+    respect to the directory of the manifest. Returns the list
+    of jobs as dictionaries.
+    '''
+    try:
+        with open(filename) as f:
+            jobs = json.load(f)
+    except (IOError, OSError):
+        raise ParseError('Unable to open "{0}" for reading.'.format(filename))
+    except ValueError:
+        raise ParseError('Unable to parse the batch manifest "{0}".'.format(
+            filename), True)
+    
+    if not isinstance(jobs, list) or \
+       not all(isinstance(job, dict) for job in jobs):
+        raise ParseError('Batch manifest has to be a list of jobs.')
+    
+    root = os.path.dirname(os.path.abspath(filename))
+    
+    for job in jobs:
+        for key in ('poscar', 'procar', 'out'):
+            if key in job:
+                job[key] = os.path.join(root, job[key])
+    
+    return jobs
@@ -0,0 +1,160 @@
+#===========================================================
+#
+#  PROJECT: vasp_unfold
+#  FILE:    profiler.py
+#  VERSION: 1.5
+#  DATE:    October 17th 2026
+#
+#===========================================================
+
+import os
+import sys
+import time
+import json
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    # Peak memory is not reported where resource is missing
+    resource = None
+
+
+def peak_rss(who='self'):
+    '''Returns peak resident memory of the process, or of its
+    terminated child processes if who is "children", in MB.
+    '''
+    if resource is None:
+        return None
+    
+    if who == 'self':
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    else:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    
+    # Linux reports kilobytes and macOS reports bytes
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss/2.0**20
+    else:
+        return usage.ru_maxrss/2.0**10
+    
+    
+class Profiler(object):
+    '''Records wall time, CPU time and peak resident memory of
+    the stages of a run, together with counters such as number
+    of k-points and bytes read and written. Stages which are
+    entered several times, possibly from several threads, are
+    accumulated. CPU time of a stage is the CPU time of the
+    whole process while the stage was running, so it includes
+    stages overlapping with it in other threads. Peak memory
+    can not be measured for a single stage, so the peak of the
+    process at the end of the stage is recorded, together with
+    the growth of the peak while the stage was running, which
+    is nonzero only for the stages that raised it. If enabled
+    is False, nothing is recorded.
+    '''
+    
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self.index = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        
+        self.wall = time.time()
+        self.cpu = os.times()
+    
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Context manager recording the enclosed code as the
+        stage with the given name.
+        '''
+        if not self.enabled:
+            yield
+            
+            return
+        
+        wall = time.time()
+        cpu = sum(os.times()[:2])
+        peak = peak_rss()
+        
+        try:
+            yield
+        finally:
+            wall = time.time()-wall
+            cpu = sum(os.times()[:2])-cpu
+            
+            with self.lock:
+                if name not in self.index:
+                    self.index[name] = len(self.stages)
+                    self.stages.append({'name': name, 'wall': 0.0,
+                        'process_cpu': 0.0, 'calls': 0, 
+                        'peak_rss_growth_mb': 0.0})
+                
+                s = self.stages[self.index[name]]
+                
+                s['wall'] += wall
+                s['process_cpu'] += cpu
+                s['calls'] += 1
+                s['process_peak_rss_mb'] = peak_rss()
+                
+                if peak is not None:
+                    s['peak_rss_growth_mb'] += s['process_peak_rss_mb']-peak
+                else:
+                    s['peak_rss_growth_mb'] = None
+    
+    
+    def count(self, name, value):
+        '''Adds the value to the counter with the given name
+        '''
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0)+value
+    
+    
+    def report(self):
+        '''Returns the report as a dictionary. Throughputs are
+        given per second of the whole run for k-points, of the
+        parsing for bytes read and of the writing for bytes
+        written, which is the total of writing all irreps.
+        '''
+        cpu = os.times()
+        
+        wall = time.time()-self.wall
+        
+        total = {'wall': wall,
+                 'cpu': sum(cpu[:2])-sum(self.cpu[:2]),
+                 'cpu_children': sum(cpu[2:4])-sum(self.cpu[2:4]),
+                 'peak_rss_mb': peak_rss(),
+                 'peak_rss_children_mb': peak_rss('children')}
+        
+        def rate(value, stages):
+            t = sum(s['wall'] for s in self.stages if s['name'] in stages)
+            
+            return value/t if value is not None and t > 0 else None
+        
+        mb = 2.0**20
+        
+        kpoints = self.counters.get('kpoints')
+        read = self.counters.get('bytes_read')
+        written = self.counters.get('bytes_written')
+        
+        writes = [s['name'] for s in self.stages 
+            if s['name'].startswith('write')]
+        
+        throughput = {
+            'kpoints_per_s': kpoints/wall if kpoints is not None else None,
+            'read_mb_per_s': rate(read and read/mb, ['parse_procar']),
+            'write_mb_per_s': rate(written and written/mb, writes)}
+        
+        return {'stages': self.stages, 'total': total,
+                'counters': self.counters, 'throughput': throughput}
+    
+    
+    def dump(self, fname):
+        '''Writes the report into the JSON file
+        '''
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
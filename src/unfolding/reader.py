@@ -0,0 +1,382 @@
+#===========================================================
+#
+#  PROJECT: vasp_unfold
+#  FILE:    reader.py
+#  VERSION: 1.5
+#  DATE:    October 17th 2026
+#
+#===========================================================
+
+import numpy as np
+from errors import ParseError
+
+
+def line_bounds(buff):
+    '''Locates all complete nonblank lines in the buffer.
+    Returns arrays with line starts and line ends (positions
+    of the terminating newlines), and the position just past
+    the last complete line in the buffer.
+    '''
+    data = np.frombuffer(buff, np.uint8)
+    
+    ends = np.flatnonzero(data == 10)
+    
+    if len(ends) == 0:
+        return ends, ends, 0
+    
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1]+1
+    
+    # Line is not blank if it contains at least one
+    # character which is not a whitespace or control
+    # character, all of which precede the space
+    filled = np.logical_or.reduceat(data[:ends[-1]+1] > 32, starts)
+    
+    return starts[filled], ends[filled], ends[-1]+1
+    
+    
+def decode_columns(rows):
+    '''Decodes numbers from a 2D array of characters in which
+    every row holds numbers formatted in the same fixed width 
+    columns, as written by Fortran F and I edit descriptors.
+    Layout of the columns is taken from the first row. Returns
+    (nrows,ncolumns) array of numbers or None if the rows do
+    not conform to the layout. Numbers are obtained as integer
+    mantissas divided by powers of ten, so they are identical
+    to what would be obtained from parsing them as text.
+    '''
+    nrows, width = rows.shape
+    
+    digits = rows-np.uint8(48)
+    isdigit = digits <= 9
+    space = rows == 32
+    minus = rows == 45
+    dot = rows == 46
+    
+    # Column ends are the last nonblank characters 
+    # of the numbers in the first row
+    filled = ~space[0]
+    ends = np.flatnonzero(filled & ~np.append(filled[1:], False))
+    
+    if len(ends) == 0:
+        return None
+    
+    starts = np.append(0, ends[:-1]+1)
+    
+    # Required and allowed characters, and exponents
+    # of place values of every character position
+    need_digit = np.zeros(width, bool)
+    need_dot = np.zeros(width, bool)
+    allow_sign = np.zeros(width, bool)
+    expo = np.zeros(width, int)
+    column = np.zeros(width, int)
+    ndec = np.zeros(len(ends), int)
+    
+    for c, (i, j) in enumerate(zip(starts, ends)):
+        d = np.flatnonzero(dot[0,i:j+1])
+        d = i+d[0] if len(d) else j+1
+        
+        # Every number needs at least one integer digit,
+        # and the mantissa has to fit into a double
+        if d == i or j-i > 15:
+            return None
+        
+        column[i:j+1] = c
+        ndec[c] = max(j-d, 0)
+        
+        # Integer part is right aligned with optional minus
+        allow_sign[i:d-1] = True
+        need_digit[d-1:j+1] = True
+        need_dot[d:d+1] = d <= j
+        
+        expo[i:d] = j-np.arange(i, d)-(d <= j)
+        expo[d+1:j+1] = j-np.arange(d+1, j+1)
+    
+    # Decimal dots are not digits
+    need_digit &= ~need_dot
+    
+    if np.any(need_digit & ~isdigit) or np.any(need_dot != dot) or \
+       np.any(~allow_sign & minus) or \
+       np.any(~(isdigit | space | minus | dot)) or \
+       np.any(~space[:,ends[-1]+1:]):
+        return None
+    
+    # Mantissas are sums of digits times their place values.
+    # Single precision is exact for up to seven digits
+    if np.max(expo) < 7:
+        dtype = np.float32
+    else:
+        dtype = float
+    
+    place = np.zeros((width, len(ends)), dtype)
+    
+    used = need_digit | allow_sign
+    place[used, column[used]] = 10.0**expo[used]
+    
+    digits *= isdigit.view(np.uint8)
+    
+    values = np.dot(digits.astype(dtype), place).astype(float)
+    values /= 10.0**ndec
+    
+    # Minus signs can only appear in the sign columns
+    signs = np.flatnonzero(allow_sign)
+    
+    if len(signs) > 0:
+        # Sign columns of every number are adjacent
+        first = np.flatnonzero(np.diff(np.append(-1, column[signs])))
+        
+        neg = np.logical_or.reduceat(minus[:,signs], first, axis=1)
+        
+        signed = column[signs[first]]
+        
+        values[:,signed] = np.where(neg, -values[:,signed], values[:,signed])
+    
+    return values
+    
+    
+def parse_rows(buff, starts, ends):
+    '''Parses all numbers contained in the lines of the buffer
+    specified by their starts and ends in a single step. Lines
+    must be sorted and must not overlap. If all the lines have
+    the same length, they are decoded as fixed width columns,
+    otherwise they are parsed as whitespace separated text.
+    '''
+    data = np.frombuffer(buff, np.uint8)
+    
+    width = ends-starts
+    
+    if len(width) > 0 and np.all(width == width[0]):
+        # View of the buffer in which every position 
+        # starts a row of the given width
+        rows = np.lib.stride_tricks.as_strided(data, 
+            shape=(len(data)-width[0], width[0]), strides=(1, 1))
+        
+        values = decode_columns(rows[starts])
+        
+        if values is not None:
+            return values.flatten()
+    
+    # Mark the selected lines including their newlines
+    # which serve as separators between the lines
+    marks = np.zeros(len(data)+1, np.int8)
+    marks[starts] = 1
+    marks[ends+1] -= 1
+    
+    data = data[np.cumsum(marks[:-1], dtype=np.int8).astype(bool)]
+    
+    return np.fromstring(data.tobytes(), sep=' ')
+    
+    
+class LineReader(object):
+    '''Reads nonblank lines of a binary stream through a large
+    buffer. Bounds of all complete lines in the buffer are
+    located at once, so lines can be skipped, looked ahead and
+    their numbers parsed in blocks without reading the stream
+    line by line. Lines are addressed relative to the next
+    unread line. Only the read method of the stream is used,
+    so it can be a file opened by io.open or a decompressing
+    stream.
+    '''
+    
+    def __init__(self, stream, bufsize=2**24, comment=None, name=None):
+        '''Constructor takes the stream, the number of bytes read
+        at once and optionally the character starting comments,
+        which are stripped by readline.
+        '''
+        self.stream = stream
+        self.bufsize = bufsize
+        self.comment = comment
+        self.name = name or getattr(stream, 'name', None)
+        
+        self.buff = b''
+        self.starts = np.zeros(0, int)
+        self.ends = np.zeros(0, int)
+        self.tail = 0
+        self.lines = None
+        
+        # Index of the next line in the buffer and the
+        # offset of the buffer in the stream
+        self.line = 0
+        self.offset = 0
+        self.eof = False
+    
+    
+    def __iter__(self):
+        return self
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    
+    def close(self):
+        self.stream.close()
+    
+    
+    def fill(self):
+        '''Reads the next bufsize bytes of the stream into the
+        buffer, keeping the lines which are not read yet. Returns
+        False if the end of the stream was already reached.
+        '''
+        if self.eof:
+            return False
+        
+        # Unread lines and the incomplete last line are kept
+        if self.line < len(self.starts):
+            keep = self.starts[self.line]
+        else:
+            keep = self.tail
+        
+        more = self.stream.read(self.bufsize)
+        
+        if not more:
+            # Terminate the last line
+            self.eof = True
+            more = b'\n'
+        
+        self.buff = self.buff[keep:]+more
+        self.offset += keep
+        
+        self.starts, self.ends, self.tail = line_bounds(self.buff)
+        
+        self.lines = None
+        self.line = 0
+        
+        return True
+    
+    
+    def available(self):
+        '''Returns the number of unread lines in the buffer
+        '''
+        return len(self.starts)-self.line
+    
+    
+    def require(self, n):
+        '''Reads the stream until at least n unread lines are in
+        the buffer, or to the end. Returns the number of unread
+        lines in the buffer.
+        '''
+        while self.available() < n and self.fill():
+            pass
+        
+        return self.available()
+    
+    
+    def get(self, i=0):
+        '''Returns i-th unread line, stripped, as bytes. Line has
+        to be in the buffer.
+        '''
+        i += self.line
+        
+        return self.buff[self.starts[i]:self.ends[i]].strip()
+    
+    
+    def tell(self, i=0):
+        '''Returns the offset of the i-th unread line in the
+        stream. For i equal to the number of unread lines in the
+        buffer, it is the offset just past the last of them.
+        '''
+        i += self.line
+        
+        if i < len(self.starts):
+            return self.offset+self.starts[i]
+        
+        return self.offset+self.tail
+    
+    
+    def skip(self, n):
+        '''Skips n nonblank lines, reading the stream if needed.
+        Returns the number of lines skipped, which is smaller
+        than n only at the end of the stream.
+        '''
+        skipped = 0
+        
+        while True:
+            k = min(n-skipped, self.available())
+            
+            self.line += k
+            skipped += k
+            
+            if skipped == n or not self.fill():
+                return skipped
+    
+    
+    def parse(self, rows):
+        '''Parses all numbers in the unread lines with the given
+        indices in a single step, as parse_rows. Lines have to
+        be in the buffer. Returns the flat array of numbers.
+        '''
+        rows = self.line+np.asarray(rows)
+        
+        return parse_rows(self.buff, self.starts[rows], self.ends[rows])
+    
+    
+    def numbers(self, n):
+        '''Parses all numbers in the next n lines and skips them.
+        Returns the flat array of numbers.
+        '''
+        if self.require(n) < n:
+            raise ParseError('Reached end of: {0}.'.format(self.name))
+        
+        data = self.parse(np.arange(n))
+        
+        self.line += n
+        
+        return data
+    
+    
+    def readline(self, eof_error=True):
+        '''Returns the next nonblank line as a string, stripped 
+        of leading and trailing whitespaces and comments. Lines 
+        which are blank after the comment is stripped are skipped.
+        At the end of the stream, ParseError is raised if eof_error
+        is True, otherwise None is returned.
+        '''
+        while True:
+            if self.line >= len(self.starts):
+                if self.fill():
+                    continue
+                elif eof_error:
+                    raise ParseError('Reached end of: {0}.'.format(
+                        self.name))
+                
+                return None
+            
+            # Lines read one by one are sliced all at once
+            if self.lines is None:
+                self.lines = [self.buff[i:j] for i, j in 
+                    zip(self.starts.tolist(), self.ends.tolist())]
+            
+            line = self.lines[self.line].strip()
+            
+            self.line += 1
+            
+            if not isinstance(line, str):
+                line = line.decode()
+            
+            if self.comment is not None and self.comment in line:
+                # Strip comments
+                line = line[:line.find(self.comment)].strip()
+            
+            if line:
+                return line
+    
+    
+    def next(self):
+        '''Returns the next nonblank line as readline, and stops
+        the iteration at the end of the stream.
+        '''
+        line = self.readline(False)
+        
+        if line is None:
+            raise StopIteration
+        
+        return line
+    
+    
+    __next__ = next
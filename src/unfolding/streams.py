@@ -0,0 +1,373 @@
+#===========================================================
+#
+#  PROJECT: vasp_unfold
+#  FILE:    streams.py
+#  VERSION: 1.5
+#  DATE:    October 17th 2026
+#
+#===========================================================
+
+import os
+import io
+import gzip
+import bz2
+import struct
+import threading
+import subprocess
+import Queue
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # xz command is used where lzma module is missing
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    # zstd command is used where zstandard module is missing
+    zstandard = None
+
+
+# Extensions of compressed files and the commands used
+# to decompress and compress them without the module
+compressions = {'.gz': 'gzip', '.bz2': 'bzip2', '.xz': 'xz', '.zst': 'zstd'}
+
+
+def compression(fname):
+    '''Returns the extension of the compressed file, or None
+    if the file is not compressed.
+    '''
+    ext = os.path.splitext(fname)[1].lower()
+    
+    return ext if ext in compressions else None
+    
+    
+def strip_compression(fname):
+    '''Returns the file name without compression extension
+    '''
+    if compression(fname) is None:
+        return fname
+    
+    return os.path.splitext(fname)[0]
+    
+    
+def stream_size(fname):
+    '''Returns the size of the uncompressed contents of the
+    file, or None if it is not known without decompressing it.
+    For gzip files, it is taken from the trailer which holds
+    the size modulo 4 GB, so it is used only for smaller files.
+    '''
+    ext = compression(fname)
+    
+    size = os.path.getsize(fname)
+    
+    if ext is None:
+        return size
+    
+    if ext == '.gz' and size >= 18:
+        with open(fname, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            
+            isize = struct.unpack('<I', f.read(4))[0]
+        
+        # Contents are at least as large as the compressed file
+        if isize >= size and size < 2**31:
+            return isize
+    
+    return None
+    
+    
+class PipeStream(object):
+    '''File-like object which decompresses the file while
+    reading, or compresses it while writing, by running the
+    command of the compression format in a child process.
+    '''
+    
+    def __init__(self, fname, ext, mode):
+        '''Constructor starts the command for the file
+        '''
+        self.name = fname
+        self.mode = mode
+        
+        self.command = compressions[ext]
+        
+        if 'r' in mode:
+            self.file = open(fname, 'rb')
+            self.proc = subprocess.Popen([self.command, '-dc'], 
+                stdin=self.file, stdout=subprocess.PIPE)
+            self.pipe = self.proc.stdout
+        else:
+            self.file = open(fname, 'wb')
+            self.proc = subprocess.Popen([self.command, '-c'],
+                stdin=subprocess.PIPE, stdout=self.file)
+            self.pipe = self.proc.stdin
+    
+    
+    def read(self, size=-1):
+        data = self.pipe.read(size)
+        
+        # Failure of the command is detected at the end of its output
+        if not data or size < 0:
+            self.check()
+        
+        return data
+    
+    
+    def readline(self):
+        line = self.pipe.readline()
+        
+        if not line:
+            self.check()
+        
+        return line
+    
+    
+    def write(self, data):
+        self.pipe.write(data)
+    
+    
+    def check(self):
+        '''Waits for the command to finish and raises IOError
+        if it failed.
+        '''
+        if self.proc.wait() != 0:
+            raise IOError('Unable to process "{0}" with {1}.'.format(
+                self.name, self.command))
+    
+    
+    def close(self):
+        '''Closes the pipe and waits for the command to finish.
+        Unread data is discarded. Raises IOError if the command
+        failed while writing.
+        '''
+        if self.file.closed:
+            return
+        
+        if 'r' in self.mode:
+            if self.proc.poll() is None:
+                self.proc.terminate()
+            
+            self.pipe.close()
+            self.proc.wait()
+            self.file.close()
+        else:
+            try:
+                self.pipe.close()
+                self.check()
+            finally:
+                self.file.close()
+    
+    
+class ZstdStream(object):
+    '''File-like object which reads or writes the zstd file
+    with the zstandard module.
+    '''
+    
+    def __init__(self, fname, mode):
+        '''Constructor opens the file and the zstd stream
+        '''
+        self.name = fname
+        
+        if 'r' in mode:
+            self.file = open(fname, 'rb')
+            self.stream = zstandard.ZstdDecompressor().stream_reader(
+                self.file)
+        else:
+            self.file = open(fname, 'wb')
+            self.stream = zstandard.ZstdCompressor().stream_writer(
+                self.file)
+    
+    
+    def read(self, size=-1):
+        return self.stream.read(size)
+    
+    
+    def write(self, data):
+        self.stream.write(data)
+    
+    
+    def close(self):
+        if self.file is None:
+            return
+        
+        try:
+            self.stream.close()
+        finally:
+            if not self.file.closed:
+                self.file.close()
+            
+            self.file = None
+    
+    
+class ThreadedReader(object):
+    '''Reads the stream in a background thread, so that the
+    decompression overlaps with the processing of the data
+    already read. At most depth blocks of blocksize bytes
+    are held in memory waiting to be read. Errors raised
+    while reading are raised by the read methods.
+    '''
+    
+    def __init__(self, stream, blocksize=2**22, depth=4):
+        '''Constructor starts the thread reading the stream
+        '''
+        self.stream = stream
+        self.name = getattr(stream, 'name', None)
+        self.blocksize = blocksize
+        self.queue = Queue.Queue(depth)
+        self.buff = b''
+        self.eof = False
+        self.stopped = False
+        self.error = None
+        
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    
+    def run(self):
+        '''Reads the blocks until the end of the stream, which
+        is marked by an empty block.
+        '''
+        try:
+            while not self.stopped:
+                block = self.stream.read(self.blocksize)
+                
+                self.queue.put(block)
+                
+                if not block:
+                    break
+        except Exception as exc:
+            self.error = exc
+            
+            self.queue.put(b'')
+    
+    
+    def next_block(self):
+        '''Returns the next block read by the thread, or an
+        empty string at the end of the stream.
+        '''
+        if self.eof:
+            return b''
+        
+        block = self.queue.get()
+        
+        if not block:
+            self.eof = True
+            
+            if self.error is not None:
+                raise self.error
+        
+        return block
+    
+    
+    def read(self, size=-1):
+        '''Returns at most size bytes, or all remaining bytes
+        if size is negative.
+        '''
+        parts = [self.buff]
+        
+        n = len(self.buff)
+        
+        while size < 0 or n < size:
+            block = self.next_block()
+            
+            if not block:
+                break
+            
+            parts.append(block)
+            
+            n += len(block)
+        
+        data = b''.join(parts)
+        
+        if size < 0:
+            size = n
+        
+        self.buff = data[size:]
+        
+        return data[:size]
+    
+    
+    def readline(self):
+        '''Returns the next line including the newline, or an
+        empty string at the end of the stream.
+        '''
+        i = self.buff.find(b'\n')
+        
+        while i < 0:
+            block = self.next_block()
+            
+            if not block:
+                break
+            
+            # Search only the newly added block
+            i = block.find(b'\n')
+            
+            if i >= 0:
+                i += len(self.buff)
+            
+            self.buff += block
+        
+        i = i+1 if i >= 0 else len(self.buff)
+        
+        line = self.buff[:i]
+        
+        self.buff = self.buff[i:]
+        
+        return line
+    
+    
+    def close(self):
+        '''Stops the thread and closes the stream
+        '''
+        self.stopped = True
+        
+        # Thread waiting for space in the queue is released
+        while self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                self.thread.join(0.01)
+        
+        self.stream.close()
+    
+    
+def open_stream(fname, mode='rb', threaded=False, buffering=-1):
+    '''Opens the file for reading or writing, compressing or
+    decompressing it if its extension is .gz, .bz2, .xz or
+    .zst. Modules of the compression formats are used if they
+    are available, otherwise their commands. If threaded is
+    True, the compressed file is read in a background thread.
+    Uncompressed files are opened with the given buffering,
+    by io.open if they are read in binary mode. Returns the 
+    file-like object.
+    '''
+    ext = compression(fname)
+    
+    if ext is None and mode == 'rb':
+        return io.open(fname, mode, buffering)
+    elif ext is None:
+        return open(fname, mode, buffering)
+    
+    if 'r' in mode and not os.path.isfile(fname):
+        raise IOError('File "{0}" does not exist.'.format(fname))
+    
+    if ext == '.gz':
+        stream = gzip.open(fname, mode[0]+'b', 6)
+    elif ext == '.bz2':
+        stream = bz2.BZ2File(fname, mode[0]+'b')
+    elif ext == '.xz' and lzma is not None:
+        stream = lzma.LZMAFile(fname, mode[0]+'b')
+    elif ext == '.zst' and zstandard is not None:
+        stream = ZstdStream(fname, mode)
+    else:
+        stream = PipeStream(fname, ext, mode)
+    
+    if threaded and 'r' in mode:
+        return ThreadedReader(stream)
+    
+    return stream
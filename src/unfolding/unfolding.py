@@ -9,39 +9,137 @@
 #
 #===========================================================
 
+import collections
 import numpy as np
-from utils import post_error, frac_translation_order
+from utils import frac_translation_order
+from parse import Orbitals
+from errors import SymmetryError
 
 
-def build_operators(spos, trans, check_mapping=False, eps=1e-6):
+def match_positions(spos, tpos, eps=1e-6):
+    '''Given two lists of fractional positions, find all pairs
+    of positions which are identical up to a lattice translation,
+    ie. |si-tj-rint(si-tj)|<eps. Positions are hashed into a
+    periodic grid whose cells are not smaller than eps, so that
+    only positions in the neighbouring cells are compared. Returns
+    two index arrays, one into tpos and the other into spos.
+    '''
+    natoms = len(spos)
+    
+    # Aim for a few positions per grid cell. Grid cell must
+    # not be smaller than eps, and with less than three cells
+    # per direction neighbouring cells are not distinct, so
+    # everything is kept in a single cell in that case
+    ngrid = int(min(natoms**(1.0/3), 1.0/eps))
+    
+    if ngrid < 3:
+        ngrid = 1
+        offsets = np.zeros((1, 3), int)
+    else:
+        offsets = np.indices((3, 3, 3)).reshape((3, -1)).T-1
+    
+    def cells(pos):
+        return np.floor((pos%1)*ngrid).astype(int)%ngrid
+    
+    def keys(c):
+        return (c[:,0]*ngrid+c[:,1])*ngrid+c[:,2]
+    
+    # Sort source positions by their grid cell
+    skeys = keys(cells(spos))
+    order = np.argsort(skeys, kind='mergesort')
+    skeys = skeys[order]
+    
+    tcells = cells(tpos)
+    
+    ti = []
+    si = []
+    
+    for off in offsets:
+        # Range of source positions sitting in the
+        # neighbouring cell of every target position
+        tkeys = keys((tcells+off)%ngrid)
+        
+        lo = np.searchsorted(skeys, tkeys, 'left')
+        hi = np.searchsorted(skeys, tkeys, 'right')
+        
+        count = hi-lo
+        
+        # Expand ranges into candidate pairs
+        t = np.repeat(np.arange(len(tpos)), count)
+        s = np.arange(np.sum(count))+np.repeat(lo-np.cumsum(count)+count, count)
+        s = order[s]
+        
+        disp = spos[s]-tpos[t]
+        disp -= np.rint(disp)
+        
+        close = np.sqrt(np.sum(disp*disp, axis=1)) < eps
+        
+        ti.append(t[close])
+        si.append(s[close])
+    
+    return np.concatenate(ti), np.concatenate(si)
+
+
+def build_operators(spos, trans, check_mapping=False, eps=1e-6, dense=False):
     '''Given a list of fractional positions, and a list of
-    fractional translations, produce a set of matrices, 
+    fractional translations, produce a set of permutations, 
     describing how fractional translations permute atomic
-    positions within the unit cell. Two fractional positions
-    si and sj are considered to be identical when |si-sj|<eps.
+    positions within the unit cell. Element ops[i, j] is the
+    index of the atom onto which i-th translation maps j-th 
+    atom, or -1 if j-th atom is not mapped onto any atom
+    (vacancies). Two fractional positions si and sj are 
+    considered to be identical when |si-sj|<eps. If dense is
+    True, permutation matrices are returned instead.
     '''
     ntrans = len(trans)
     natoms = len(spos)
     
-    ops = np.zeros((ntrans, natoms, natoms), int)
+    if dense:
+        ops = np.zeros((ntrans, natoms, natoms), int)
+    else:
+        ops = -np.ones((ntrans, natoms), int)
+        
+    # Number of atoms every atom is mapped onto
+    counts = np.zeros((ntrans, natoms), int)
     
     for i, ti in enumerate(trans):
-        for j, sj in enumerate(spos):
-            for k, sk in enumerate(spos):
-                # If displacement between two atomic positions
-                # differs from the fractional translations by
-                # by a lattice translation+-eps we consider the
-                # that two atomic positions to be map onto each
-                # other by the fractional translation
-                disp = sk-sj-ti
-                ops[i, j, k] = np.linalg.norm(disp-np.rint(disp)) < eps
-
+        # If displacement between two atomic positions
+        # differs from the fractional translations by
+        # by a lattice translation+-eps we consider the
+        # that two atomic positions to be map onto each
+        # other by the fractional translation
+        j, k = match_positions(spos, spos+ti, eps)
+        
+        counts[i] = np.bincount(j, minlength=natoms)
+        
+        if dense:
+            ops[i, j, k] = 1
+        else:
+            # In case of ambiguous matches keep the
+            # atom with the lowest index
+            order = np.lexsort((k, j))
+            
+            j = j[order]
+            k = k[order]
+            
+            first = np.ones(len(j), bool)
+            first[1:] = j[1:] != j[:-1]
+            
+            ops[i, j[first]] = k[first]
+    
     if check_mapping:
-        # Every row and every column of every operator must
-        # contain exactly one unity, otherwise translations
-        # are not maping atoms one-to-one.
-        if np.any(np.sum(ops, axis=1) != 1) or np.any(np.sum(ops, axis=2) != 1):
-            post_error('Translations are not one-to-one. '
+        # Every atom must be mapped onto exactly one atom
+        # and every atom must be mapped onto by exactly one
+        # atom, otherwise translations are not maping atoms
+        # one-to-one.
+        if dense:
+            onto = np.sum(ops, axis=1)
+        else:
+            onto = np.array([np.bincount(op[op >= 0], minlength=natoms) 
+                for op in ops])
+            
+        if np.any(counts != 1) or np.any(onto != 1):
+            raise SymmetryError('Translations are not one-to-one. '
                 'Try changing the matching tolerance, or try using '
                 'the POSCAR file with more regular positions.')
 
@@ -51,10 +149,11 @@ def build_operators(spos, trans, check_mapping=False, eps=1e-6):
 def build_translations(tgens):
     '''Build a list of translations and irreps from at most 
     three linearly independent generators specified as lists
-    of three fractions.
+    of three fractions. Orders of the generators are returned
+    as well.
     '''
     if len(tgens) > 3:
-        post_error('There can be at most three generators '
+        raise SymmetryError('There can be at most three generators '
             'of fractional translations.')
     
     # Use folded generators as floats to perform linear independece tests
@@ -65,9 +164,9 @@ def build_translations(tgens):
     
     # Check if generators are linearly independent
     if len(tgens) == 2 and np.all(np.cross(tgensf[0], tgensf[1]) < eps**2):
-        post_error('Generators are not linearly independant.')
+        raise SymmetryError('Generators are not linearly independant.')
     elif len(tgens) == 3 and np.linalg.det(np.array(tgensf)) < eps**3:
-        post_error('Generators are not linearly independant.')
+        raise SymmetryError('Generators are not linearly independant.')
         
     # Expand the generator list to be a 3x3 matrix
     tgens = np.append(tgens, np.ones((3-len(tgens), 3)), axis=0)
@@ -75,48 +174,24 @@ def build_translations(tgens):
     # Get the order of every generator
     order = np.array([frac_translation_order(g) for g in tgens], int)
     
-    # Get the corresponding roots of unity which will be
-    # used to construct irreps
-    deltag = np.exp(-2*np.pi*1j/order)
-    
     # Fold the translation vectors into the unit cell
     tgens = tgens % 1
     
-    # Total number of translations
-    ntrans = np.prod(order)
-    
-    # Storage for translations
-    trans = np.zeros((ntrans, 3), float)
-    
-    # Calculate irreps of every generator
-    irrepg = np.zeros((ntrans, 3), complex)
-    
-    # Loop over all possible products of powers of generators
-    # and store the irreps
-    for i in xrange(order[0]):
-        for j in xrange(order[1]):
-            for k in xrange(order[2]):
-                ii = i*order[1]*order[2]+j*order[2]+k
-                
-                irrepg[ii] = deltag**[i, j, k]
-    
-    # Irrep table for all translations          
-    irreps = np.zeros((ntrans, ntrans), complex)
-    
-    # Loop over all posible products of powers of generators
-    for i in xrange(order[0]):
-        for j in xrange(order[1]):
-            for k in xrange(order[2]):
-                ti = i*order[1]*order[2]+j*order[2]+k
-                
-                # Get the translation vector
-                trans[ti] = np.dot([i, j, k], tgens)%1
-                
-                # Get all irreps of that translations
-                for l in xrange(ntrans):
-                    irreps[l, ti] = np.prod(irrepg[l]**[i, j, k])
-                    
-    return trans, irreps
+    # Powers of generators for every translation. Translation
+    # ti=i*order[1]*order[2]+j*order[2]+k corresponds to 
+    # the product of generators raised to powers [i, j, k]
+    powers = np.indices(order).reshape((3, -1)).T
+    
+    # Get the translation vectors
+    trans = np.array(np.dot(powers, tgens)%1, float)
+    
+    # Irrep table for all translations. Irrep l is the product 
+    # of roots of unity of every generator raised to the powers
+    # of the translation, ie. the translation group is a product
+    # of cyclic groups
+    irreps = np.exp(-2*np.pi*1j*np.dot(powers/order.astype(float), powers.T))
+    
+    return trans, irreps, order
 
 
 def build_projectors(irreps, ops, intdim=1):
@@ -135,3 +210,294 @@ def build_projectors(irreps, ops, intdim=1):
     
     # Expand onto the orbital space and normalize
     return np.kron(projs, np.eye(intdim))/len(ops)
+    
+    
+def build_gathers(perms, intdim=1):
+    '''Expands atomic permutations onto the orbital space.
+    Intdim specifies how many orbitals per atomic site there
+    are. Element gathers[i, j] is the row of the phase array
+    which i-th translation maps onto j-th row, or -1 if there
+    is no such row.
+    '''
+    orbs = np.arange(intdim)
+    
+    gathers = perms[:,:,np.newaxis]*intdim+orbs
+    
+    # Missing atoms have no orbitals either
+    gathers[perms < 0] = -1
+    
+    return gathers.reshape((len(perms), -1))
+    
+    
+def select_orbits(perms, atoms):
+    '''Returns the sorted indices of the atoms in translation
+    orbits of the given atoms, whose phase rows are gathered to 
+    project the rows of the given atoms, together with the 
+    permutations restricted to the given atoms. Their elements
+    are positions within the returned atoms instead of atom 
+    indices, or -1 as in perms. Gathers built from them take 
+    phase arrays holding the rows of the returned atoms only.
+    '''
+    atoms = np.asarray(atoms, int)
+    
+    images = perms[:,atoms]
+    
+    ions = np.union1d(atoms, images[images >= 0])
+    
+    # Position of every atom among the ions, with
+    # the last element kept for the missing atoms
+    position = -np.ones(perms.shape[1]+1, int)
+    position[ions] = np.arange(len(ions))
+    
+    return ions, position[images]
+    
+    
+def project_phases(irrep, gathers, phases):
+    '''Projects phases onto the irrep given by its characters
+    for every translation. Instead of applying the dense
+    projector, phase rows permuted by every translation are
+    gathered and summed up weighted by the characters, which
+    amounts to O(ntrans*nions*norbs) work per band. Phases are
+    (npoints,nions*norbs,nbands,nspin) array as returned by
+    parse_procar. Projection is done in the precision of phases.
+    Rows of the result are the rows of gathers, which may be
+    fewer than the rows of phases (see select_orbits).
+    '''
+    if gathers.shape[1] > phases.shape[1] or \
+       np.max(gathers) >= phases.shape[1]:
+        raise ValueError('Gathers do not match the phase array.')
+    
+    irrep = np.asarray(irrep, phases.dtype)
+        
+    shape = (len(phases), gathers.shape[1])+phases.shape[2:]
+    
+    projected = np.zeros(shape, phases.dtype)
+    
+    # Buffer for the gathered rows
+    buff = np.empty(shape, phases.dtype)
+    
+    for chi, g in zip(irrep, gathers):
+        valid = g >= 0
+        
+        if np.all(valid):
+            np.take(phases, g, axis=1, out=buff)
+            buff *= chi
+            projected += buff
+        else:
+            # Rows without a preimage get no contribution
+            projected[:,valid] += chi*phases[:,g[valid]]
+    
+    projected /= len(gathers)
+    
+    return projected
+    
+    
+def project_all_phases(gathers, order, phases):
+    '''Projects phases onto all irreps at once. Since the 
+    translation group is a product of cyclic groups of orders
+    given by order, projection onto all irreps amounts to the
+    discrete Fourier transform over the translation orbit of
+    every row of the phase array. Phase rows are gathered once
+    for every translation and transformed with a single FFT.
+    Returns (nirreps,npoints,nions*norbs,nbands,nspin) array
+    of the same precision as phases, with the rows of gathers.
+    '''
+    if gathers.shape[1] > phases.shape[1] or \
+       np.max(gathers) >= phases.shape[1]:
+        raise ValueError('Gathers do not match the phase array.')
+    
+    ntrans = len(gathers)
+    
+    shape = (len(phases), gathers.shape[1])+phases.shape[2:]
+    
+    # Translation orbits of phase rows
+    orbits = np.zeros((ntrans,)+shape, phases.dtype)
+    
+    for t, g in enumerate(gathers):
+        valid = g >= 0
+        
+        if np.all(valid):
+            np.take(phases, g, axis=1, out=orbits[t])
+        else:
+            # Rows without a preimage stay zero
+            orbits[t][:,valid] = phases[:,g[valid]]
+    
+    # Translation index is split into powers of generators
+    orbits = orbits.reshape(tuple(order)+shape)
+    
+    # FFT is always done in double precision
+    projected = np.fft.fftn(orbits, axes=(0, 1, 2))
+    projected = projected.astype(phases.dtype, copy=False)
+    projected /= ntrans
+    
+    return projected.reshape((ntrans,)+shape)
+    
+    
+def rescale_weights(weights, unfolded, norms, tile=2**14):
+    '''Multiplies orbital weights by the magnitude ratio of 
+    unfolded and folded phases for every orbital, band and 
+    weight dimension. Norms are the magnitudes of folded 
+    phases with 1e-4 added. Returns the rescaled weights as a
+    new array. Rows of the arrays are processed in tiles of
+    about tile elements, so that the ratios stay in cache while
+    all weights are multiplied.
+    '''
+    out = np.empty_like(weights)
+    
+    if not weights.flags.c_contiguous:
+        out[:] = weights*(np.abs(unfolded)/norms)[...,np.newaxis]
+        
+        return out
+    
+    nrows = weights.shape[0]*weights.shape[1]
+    
+    w = weights.reshape((nrows,)+weights.shape[2:])
+    u = unfolded.reshape((nrows, -1))
+    n = norms.reshape((nrows, -1))
+    
+    # Result is stored through a view
+    o = out.view()
+    o.shape = w.shape
+    
+    step = max(1, tile//n.shape[1])
+    
+    ratio = np.empty((min(step, nrows), n.shape[1]), norms.dtype)
+    
+    for i in xrange(0, nrows, step):
+        r = ratio[:min(step, nrows-i)]
+        
+        np.abs(u[i:i+step], out=r)
+        r /= n[i:i+step]
+        
+        np.multiply(w[i:i+step], r[:,:,np.newaxis], out=o[i:i+step])
+    
+    return out
+    
+    
+class IrrepBlock(collections.Sequence):
+    '''Block of k-points unfolded onto a single irrep. It is a
+    sequence with the same elements as the data list yielded by
+    iter_procar. It holds the projected phases, while rescaled
+    orbital weights are derived from the original weights when
+    they are first accessed. Original arrays are shared by the
+    blocks of all irreps and are never modified.
+    '''
+    
+    def __init__(self, data, phases, norms):
+        '''Constructor takes the original data list, projected 
+        phases and magnitudes of original phases with 1e-4 added.
+        '''
+        self.original = data
+        self.phases = phases
+        self.norms = norms
+        self.rescaled = None
+        
+        
+    @property
+    def weights(self):
+        '''Orbital weights rescaled for the irrep
+        '''
+        if self.rescaled is None:
+            self.rescaled = rescale_weights(self.original[-2], self.phases, 
+                self.norms)
+        
+        return self.rescaled
+        
+        
+    def __len__(self):
+        return len(self.original)
+        
+        
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        
+        if i < 0:
+            i += len(self)
+        
+        if i == len(self)-1:
+            return self.phases
+        elif i == len(self)-2:
+            return self.weights
+        else:
+            return self.original[i]
+    
+    
+def unfold_block(data, gathers, irreps, order=None):
+    '''Unfolds a block of k-points as yielded by iter_procar.
+    Phases are projected onto the first irrep, or onto all
+    irreps if the orders of the generators are given. Yields 
+    IrrepBlock for every irrep, whose orbital weights are the
+    original weights multiplied by the magnitude ratio of 
+    unfolded and folded phases. Arrays of the data list are
+    made read-only, since they are shared by all irreps. If
+    gathers have fewer rows than phases (see select_orbits), 
+    only the rows onto which the identity maps are unfolded.
+    '''
+    for a in data[1:]:
+        a.flags.writeable = False
+    
+    phases = data[-1]
+    
+    if order is None:
+        projected = [project_phases(irreps[0], gathers, phases)]
+    else:
+        # Projections onto all irreps are obtained at once
+        projected = project_all_phases(gathers, order, phases)
+    
+    # Rows of the translation orbits are left out
+    if gathers.shape[1] != phases.shape[1]:
+        rows = gathers[0]
+        
+        # Ions which are left, as indices in the file
+        ions = rows[::len(data[0])]//len(data[0])
+        
+        if getattr(data[0], 'ions', None) is not None:
+            ions = np.asarray(data[0].ions)[ions]
+        
+        orbitals = Orbitals(data[0], ions.tolist(), 
+            getattr(data[0], 'columns', None))
+        
+        data = [orbitals]+list(data[1:-2])+[data[-2][:,rows], phases[:,rows]]
+    
+    # Magnitudes of folded phases are the same for all irreps
+    norms = np.abs(data[-1])
+    norms += 1e-4
+    
+    for p in projected:
+        yield IrrepBlock(data, p, norms)
+    
+    
+def spectral_function(bands, weights, energies, width, smearing='lorentzian',
+                      size=2**22):
+    '''Broadens the bands of a block of k-points, given as 
+    (nk,nbands) arrays of energies and weights, into the 
+    spectral function on the grid of energies. Every band 
+    contributes its weight times the Lorentzian with half 
+    width at half maximum width, or the Gaussian with standard
+    deviation width if smearing is "gaussian". Grid is processed
+    in blocks of about size elements of (nk,nbands,nenergies)
+    array. Returns (nk,nenergies) array.
+    '''
+    nk, nbands = bands.shape
+    
+    result = np.empty((nk, len(energies)), float)
+    
+    step = max(1, size//max(1, nk*nbands))
+    
+    for i in xrange(0, len(energies), step):
+        # Line shape of every band at the grid energies
+        x = energies[i:i+step]-bands[:,:,np.newaxis]
+        x *= x
+        
+        if smearing == 'gaussian':
+            x *= -0.5/width**2
+            np.exp(x, out=x)
+            x *= 1/(width*np.sqrt(2*np.pi))
+        else:
+            x += width**2
+            np.divide(width/np.pi, x, out=x)
+        
+        result[:,i:i+step] = np.einsum('kb,kbe->ke', weights, x)
+    
+    return result
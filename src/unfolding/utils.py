@@ -14,82 +14,44 @@ import argparse
 import sys
 import fractions
 import traceback
+from errors import InputError
+from streams import open_stream
+from reader import LineReader
 
         
-def post_error(error_info, show_traceback=False):
-    '''Write error message to sderr and exit program
+def post_error(error_info, show_traceback=False, tb_msg=None):
+    '''Write error message to sderr and exit program with
+    status 1. The traceback shown is tb_msg if given, otherwise
+    the one of the exception being handled.
     '''
     message = '\nError: '+error_info+'\n\n'
     
     if show_traceback:
         # Show exception traceback
-        tb_msg = traceback.format_exc()
+        if tb_msg is None:
+            tb_msg = traceback.format_exc()
         
         max_line_len = max(len(line) for line in tb_msg.split('\n'))
         
         message += 'Operation failed due to the following exception:\n'
         message += '='*max_line_len
-        message += '\n' + traceback.format_exc()
+        message += '\n' + tb_msg
         message += '='*max_line_len
     
     sys.stderr.write(message)
     
-    exit()
+    sys.exit(1)
     
     
-class Getlines(file):
-    '''Small wrapper of the Python's built-in file
-    class. It's purpose is to skip empty lines
-    while reading the file'''
+class Getlines(LineReader):
+    '''LineReader of the file opened by open_stream, so
+    that compressed files can be read as well. It's purpose
+    is to skip empty lines while reading the file'''
     
-    def __init__(self, fname, comment=None):
+    def __init__(self, fname, comment=None, bufsize=2**16):
         '''Constructor opens the file in the read mode'''
-        super(Getlines, self).__init__(fname, 'r')
-        self.comment = comment
-    
-    
-    def __advance__(self, advance_func, eof_error):
-        '''Advances along file line by line, skipping empty
-        lines and stripping trailing and leading whitspaces 
-        and comments. advance_func specifies function which
-        provides contents of next line. If eof_error is True
-        error will be posted and execution terminated if end
-        of file is reached.
-        '''
-        line = ''
-        
-        while len(line) == 0:
-            line = advance_func()
-            
-            if line == '':
-                if eof_error is True:
-                    post_error('Reached end of: {0}.'.format(self.name))
-                else:
-                    return None
-            if self.comment is not None:
-                # Strip comments
-                line = line[:line.find(self.comment)]
-            
-            # Strip spaces
-            line = line.strip()
-            
-        return line
-        
-        
-    def next(self):
-        '''Overides file.next() so that empty lines are skipped
-        and leading and trailing whitespaces and comments stripped.
-        '''
-        return self.__advance__(super(Getlines, self).next, False)
-    
-        
-    def readline(self, eof_error=True):
-        '''Overides file.readline() so that empty lines are skipped
-        and leading and trailing whitespaces and comments stripped. 
-        Optionally, if eof_error is True, error will be posted and 
-        execution terminated in case end of file is reached
-        '''
-        return self.__advance__(super(Getlines, self).readline, eof_error)
+        super(Getlines, self).__init__(open_stream(fname, 'rb'), bufsize, 
+            comment, fname)
 
     
 def translation(tstring):
@@ -102,8 +64,8 @@ def translation(tstring):
     try:
         return [fractions.Fraction(s) if s.strip() != "0" else 1 for s in tstring.split(',')]
     except:
-        post_error('Unable to parse string: "{0}". Check help for valid '
-                   'translation generator specification'.format(tstring))
+        raise InputError('Unable to parse string: "{0}". Check help for valid '
+                         'translation generator specification'.format(tstring))
 
 def version(vstring):
     '''Parse string containing version information.
@@ -113,9 +75,86 @@ def version(vstring):
     try:
         return tuple(int(d) for d in vstring.split('.'))
     except:
-        post_error('Unable to parse string: "{0}". The valid version '
-                   'is composed of dot separated digists'.format(vstring))
+        raise InputError('Unable to parse string: "{0}". The valid version '
+                         'is composed of dot separated digists'.format(vstring))
                    
+
+def energy_grid(gstring):
+    '''Parse string describing the energy grid as comma
+    separated lowest and highest energy and number of
+    energies. Returns the array of energies.
+    '''
+    try:
+        emin, emax, n = gstring.split(',')
+        
+        emin, emax, n = float(emin), float(emax), int(n)
+    except:
+        n = 0
+    
+    if n < 1 or (n > 1 and not emin < emax):
+        raise InputError('Unable to parse string: "{0}". The valid energy '
+                         'grid is EMIN,EMAX,NE with EMIN < EMAX and NE '
+                         'positive'.format(gstring))
+    
+    return np.linspace(emin, emax, n)
+
+
+def join_values(argv, options):
+    '''Joins the given options and the arguments following
+    them into OPTION=VALUE arguments, so that values starting
+    with a minus, such as negative energies, are not taken
+    for options by argparse. Returns the new argument list.
+    '''
+    joined = []
+    
+    i = 0
+    
+    while i < len(argv):
+        if argv[i] in options and i+1 < len(argv):
+            joined.append(argv[i]+'='+argv[i+1])
+            
+            i += 2
+        else:
+            joined.append(argv[i])
+            
+            i += 1
+    
+    return joined
+
+
+def selection(sstring):
+    '''Parse string describing a selection of atoms or
+    orbitals as comma separated items. Items which are
+    positive integers or their ranges such as 1-4 are
+    returned as indices starting from 0, other items are
+    returned as strings.
+    '''
+    items = []
+    
+    for item in sstring.split(','):
+        item = item.strip()
+        
+        first, dash, last = item.partition('-')
+        
+        try:
+            if dash:
+                indices = range(int(first), int(last)+1)
+            else:
+                indices = [int(item)]
+        except ValueError:
+            indices = None
+        
+        if indices is None:
+            items.append(item)
+        elif indices and min(indices) > 0:
+            items += [i-1 for i in indices]
+        else:
+            raise InputError('Unable to parse string: "{0}". Atoms are '
+                             'numbered from 1'.format(sstring))
+    
+    return items
+
+
 def lcm(a, b):
     '''Return lowest common multiple.'''
     return a * b // fractions.gcd(a, b)
@@ -9,131 +9,455 @@
 #
 #===========================================================
 
+import os
+import json
 import numpy as np
-from utils import post_error
+from errors import OutputError
+from streams import open_stream
+from unfolding import spectral_function
 
 
-def write_procar(fname, orbitals, kpoints, kweights, bands, 
-                 occupations, weights, phases):
-    '''Write PROCAR file based on supplied data
+# Names of the arrays stored by NpyWriter in the
+# order they are returned by parse_procar
+array_names = ['kpoints', 'kweights', 'bands', 'occupancies',
+               'weights', 'phases']
+
+
+# Labels for orbitals
+orblabels = ['s', 'py', 'pz', 'px', 'dxy', 'dyz', 'dz2', 'dxz', 'dx2',
+             'f-3', 'f-2', 'f-1', 'f0', 'f1', 'f2', 'f3']
+
+
+def open_procar(fname, phases):
+    '''Opens PROCAR file for writing and writes its first
+    line. Phases specify whether phase information will be
+    written. File is compressed if its extension is .gz, .bz2, 
+    .xz or .zst. Returns the file object.
     '''
-    # Labels for orbitals
-    orblabels = ['s', 'py', 'pz', 'px', 'dxy', 'dyz', 'dz2', 'dxz', 'dx2',
-                 'f-3', 'f-2', 'f-1', 'f0', 'f1', 'f2', 'f3']
-    
-    norb = len(orbitals)
-    npoints = len(kpoints)
-    nbands = bands.shape[1]
-    nions = weights.shape[1]/norb
-    nspin = weights.shape[-1]
-    ndim = weights.shape[-2]
-    
     try:
-        out = open(fname, 'w')
+        out = open_stream(fname, 'w', buffering=2**20)
     except:
-        post_error('Unable to open "{0}" for writing'.format(fname))
+        raise OutputError('Unable to open "{0}" for writing'.format(fname))
     
     # Write the first line of the PROCAR file
-    if phases is not None:
+    if phases:
         out.write('PROCAR lm decomposed + phase\n')
     else:
         out.write('PROCAR lm decomposed\n')
+    
+    return out
+    
 
+def format_kpoints(first, npoints, orbitals, kpoints, kweights, 
+                   bands, occupations, weights, phases):
+    '''Formats a block of consecutive k-points of a single spin 
+    component as text of the PROCAR file. First is the index of
+    the first k-point in the block and npoints is the total
+    number of k-points. Arrays are shaped as those returned by
+    parse_procar, but without the spin axis. If only some of
+    the ions and orbitals are held (see parse.Orbitals), they 
+    are written with their numbers and labels in the file.
+    '''
+    norb = len(orbitals)
+    nk, nbands = bands.shape
+    nions = weights.shape[1]/norb
+    ndim = weights.shape[-1]
+    
+    columns = getattr(orbitals, 'columns', None) or range(norb)
+    ions = getattr(orbitals, 'ions', None) or range(nions)
+    
     # Format out the column title line for orbital weights
     orb_ttl_1 = 'ion '
     orb_ttl_2 = 'ion '
     
-    for i in xrange(norb):
+    for i in columns:
         orb_ttl_1 += '{0: >6} '.format(orblabels[i])
         orb_ttl_2 += '{0: >6} '.format(orblabels[i])
     
     orb_ttl_1 += '{0: >6}\n'.format('tot')
     orb_ttl_2 += '\n'
     
-    for s in xrange(nspin):
+    # Every k-point is written with a single format operation.
+    # Template for a band consists of the band info, absolute
+    # weight blocks (four in case of non-collinear calculation)
+    # each followed by the line with orbital totals, and phases
+    row = '%6.3f '*norb
+    
+    block = ''.join('{0: >3} '.format(k+1)+row+'%6.3f\n' for k in ions)
+    block += 'tot '+row+'%6.3f\n'
+    
+    band = 'band %4d # energy %13.8f # occ. %11.8f\n\n'+orb_ttl_1+block*ndim
+    
+    if phases is not None:
+        band += orb_ttl_2
+        band += ''.join('{0: >3} '.format(k+1)+row+'\n{0: >3} '.format(k+1)+
+            row+'\n' for k in ions)
+        band += '\n'
+    
+    template = ' k-point %4d :    %.8f %.8f %.8f     weight = %.8f\n\n'+\
+        band*nbands+'\n'
+    
+    # Weights of every atom as (nk,nbands,ndim,nions,norb) array
+    w = weights.reshape((nk, nions, norb, nbands, ndim))
+    w = np.ascontiguousarray(w.transpose((0, 3, 4, 1, 2)))
+    
+    # Table of weights with atom totals in the last column
+    # and orbital totals in the last row. Atom totals are 
+    # summed in the precision of weights, orbital totals
+    # are accumulated atom by atom in double precision
+    table = np.zeros((nk, nbands, ndim, nions+1, norb+1), float)
+    
+    table[:,:,:,:nions,:norb] = w
+    table[:,:,:,:nions,norb] = np.sum(w, axis=-1)
+    
+    for k in xrange(nions):
+        table[:,:,:,nions,:norb] += w[:,:,:,k]
+    
+    table[:,:,:,nions,norb] = np.sum(table[:,:,:,nions,:norb], axis=-1)
+    
+    # Values for every band in the order of the template
+    values = [np.arange(1, nbands+1)*np.ones((nk, 1)), bands, occupations, 
+        table.reshape((nk, nbands, -1))]
+    
+    if phases is not None:
+        # Real and imaginary parts in alternating rows
+        p = phases.reshape((nk, nions, norb, nbands))
+        p = np.array([p.real, p.imag]).transpose((1, 4, 2, 0, 3))
+        
+        values.append(p.reshape((nk, nbands, -1)))
+    
+    values = np.concatenate([np.reshape(v, (nk, nbands, -1)) 
+        for v in values], axis=-1)
+    
+    # Values for every k-point in the order of the template
+    values = np.concatenate((np.arange(first+1, first+nk+1)[:,np.newaxis], 
+        kpoints, kweights[:,np.newaxis], values.reshape((nk, -1))), axis=1)
+    
+    text = []
+    
+    if first == 0:
         # Write the second line containing the sizes
-        out.write('# of k-points:  {0}         # of bands:  {1}'
+        text.append('# of k-points:  {0}         # of bands:  {1}'
               '         # of ions:   {2}\n\n'.format(npoints, nbands, nions))
-              
-        for i, k in enumerate(kpoints):
-            # Write the k-point info
-            out.write(' k-point {0: >4} :    '.format(i+1))
-            out.write('{0:.8f} {1:.8f} {2:.8f}     '.format(*k))
-            out.write('weight = {0:.8f}\n\n'.format(kweights[i]))
-            
-            for j, b in enumerate(bands[i,:,s]):
-                # Write the band info
-                out.write('band {0: >4} # '.format(j+1))
-                out.write('energy {0: >13.8f} # '.format(b))
-                out.write('occ. {0: >11.8f}\n\n'.format(occupations[i, j, s]))
+    
+    for v in values:
+        text.append(template % tuple(v.tolist()))
+    
+    return ''.join(text)
+    
+    
+def write_kpoints(out, *args):
+    '''Appends a block of k-points formatted by format_kpoints 
+    to the PROCAR file opened with open_procar.
+    '''
+    out.write(format_kpoints(*args))
+
+
+def write_procar(fname, orbitals, kpoints, kweights, bands, 
+                 occupations, weights, phases):
+    '''Write PROCAR file based on supplied data
+    '''
+    out = open_procar(fname, phases is not None)
+    
+    for s in xrange(weights.shape[-1]):
+        if phases is not None:
+            phs = phases[:,:,:,s]
+        else:
+            phs = None
+        
+        write_kpoints(out, 0, len(kpoints), orbitals, kpoints, kweights, 
+            bands[:,:,s], occupations[:,:,s], weights[:,:,:,:,s], phs)
                 
-                # Write absolute weight blocks. In case of 
-                # non-collinear calculation, there is four
-                # such blocks
-                for d in xrange(ndim):
-                    if d == 0:
-                        # Write names of orbitals (s, px, py etc...)
-                        out.write(orb_ttl_1)
-                    
-                    # Allocate storage for accumulation of orbital totals
-                    tot_orb = np.zeros(norb, float)
-                    
-                    # Loop over individual atoms
-                    for k in xrange(nions):
-                        # Write atom's index
-                        out.write('{0: >3} '.format(k+1))
-                        
-                        # Extract corresponding weights
-                        w = weights[i, k*norb:(k+1)*norb, j,d,s]
-                        
-                        # Add to totals
-                        tot_orb += w
-                        
-                        # Write out row of weights
-                        for l in xrange(norb):
-                            out.write('{0: >6.3f} '.format(w[l]))
-                        
-                        # Write atom total
-                        out.write('{0: >6.3f}\n'.format(np.sum(w)))
-                    
-                    # We will now write line with orbital totals
-                    out.write('tot ')
-                    
-                    for l in xrange(norb):
-                        out.write('{0: >6.3f} '.format(tot_orb[l]))
-                    
-                    # Finally, atom+orbital total
-                    out.write('{0: >6.3f}\n'.format(np.sum(tot_orb)))
+    out.close()
+    
+    
+class ProcarWriter(object):
+    '''Writes blocks of k-points yielded by iter_procar
+    into a text PROCAR file.
+    '''
+    
+    def __init__(self, fname, phases=True):
+        '''Constructor opens the file for writing
+        '''
+        self.out = open_procar(fname, phases)
+        
+        
+    def write(self, s, first, npoints, nspin, data):
+        '''Appends a block of k-points of s-th spin component
+        '''
+        write_kpoints(self.out, first, npoints, *data)
+        
+        
+    def write_text(self, text):
+        '''Appends a block of k-points formatted by format_kpoints
+        '''
+        self.out.write(text)
+        
+        
+    def close(self):
+        self.out.close()
+        
+        
+class BlockWriter(object):
+    '''Stores blocks of k-points yielded by iter_procar into
+    arrays holding the data returned by parse_procar, with the
+    spin components along the last axis. Subclasses provide
+    the storage of the arrays through allocate.
+    '''
+    
+    def __init__(self):
+        self.arrays = None
+        self.orbitals = None
+        self.nspin = 0
+        
+        
+    def allocate(self, name, dtype, shape):
+        '''Returns a new array for the data of the given name
+        '''
+        raise NotImplementedError
+        
+        
+    def replace(self, name, a):
+        '''Replaces the array of the given name by the resized
+        one returned by allocate
+        '''
+        self.arrays[name] = a
+        
+        
+    def resize(self, nspin):
+        '''Changes the number of spin components of the arrays
+        '''
+        for name, a in self.arrays.items():
+            if name in ('kpoints', 'kweights'):
+                continue
+            
+            b = self.allocate(name, a.dtype, a.shape[:-1]+(nspin,))
+            
+            n = min(nspin, a.shape[-1])
+            
+            b[...,:n] = a[...,:n]
+            
+            del a
+            
+            self.replace(name, b)
+        
+        
+    def write(self, s, first, npoints, nspin, data):
+        '''Stores a block of k-points of s-th spin component.
+        Arrays are allocated for nspin components and extended
+        if the number of spin components turns out to be larger.
+        '''
+        if self.arrays is None:
+            self.arrays = {}
+            self.orbitals = data[0]
+            
+            for name, b in zip(array_names, data[1:]):
+                if b is None:
+                    continue
                 
-                # If we have phases we write them now
-                if phases is not None:
-                    # Write again names of orbitals
-                    out.write(orb_ttl_2)
-                    
-                    # Loop over atoms
-                    for k in xrange(nions):
-                        # Write atom index
-                        out.write('{0: >3} '.format(k+1))
-                        
-                        # Extract corresponding phase
-                        phs = phases[i, k*norb:(k+1)*norb, j, s]
-                        
-                        # Write real part
-                        for l in xrange(norb):
-                            out.write('{0: >6.3f} '.format(phs[l].real))
-                        
-                        # Write atom index
-                        out.write('\n{0: >3} '.format(k+1))
-                        
-                        # Write imaginary part
-                        for l in xrange(norb):
-                            out.write('{0: >6.3f} '.format(phs[l].imag))
-                        
-                        out.write('\n')
-                    
-                    out.write('\n')
+                # K-points are stored only once and
+                # other arrays get the spin axis
+                shape = (npoints,)+b.shape[1:]
                 
-            out.write('\n')
+                if name not in ('kpoints', 'kweights'):
+                    shape += (nspin,)
                 
-    out.close()
-
+                self.arrays[name] = self.allocate(name, b.dtype, shape)
+        
+        if s >= self.arrays['bands'].shape[-1]:
+            self.resize(s+1)
+        
+        nk = len(data[1])
+        
+        for name, b in zip(array_names, data[1:]):
+            if name in ('kpoints', 'kweights'):
+                if s == 0:
+                    self.arrays[name][first:first+nk] = b
+            elif b is not None:
+                self.arrays[name][first:first+nk,...,s] = b
+        
+        self.nspin = max(self.nspin, s+1)
+        
+        
+    def trim(self):
+        '''Removes the spin components which were not written
+        '''
+        if self.nspin < self.arrays['bands'].shape[-1]:
+            self.resize(self.nspin)
+        
+        
+class NpyWriter(BlockWriter):
+    '''Writes blocks of k-points yielded by iter_procar into
+    a directory holding every array returned by parse_procar
+    as a .npy file and a JSON manifest describing them. Arrays
+    are written through memory maps, so the memory used does
+    not depend on their size, and can be memory mapped by the
+    readers as well (see parse.load_npy).
+    '''
+    
+    def __init__(self, dirname, info=None):
+        '''Constructor creates the directory. Info is a dictionary
+        of additional entries for the manifest.
+        '''
+        super(NpyWriter, self).__init__()
+        
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        
+        self.dirname = dirname
+        self.info = dict(info or {})
+        
+        
+    def path(self, name):
+        return os.path.join(self.dirname, name+'.npy')
+        
+        
+    def allocate(self, name, dtype, shape):
+        '''Creates the .npy file of the array. Resized arrays
+        are created next to the old ones and renamed by replace.
+        '''
+        path = self.path(name)
+        
+        if name in self.arrays:
+            path += '.tmp'
+        
+        return np.lib.format.open_memmap(path, 'w+', dtype, shape)
+        
+        
+    def replace(self, name, a):
+        a.flush()
+        
+        os.rename(self.path(name)+'.tmp', self.path(name))
+        
+        self.arrays[name] = a
+        
+        
+    def close(self):
+        '''Flushes the arrays and writes the manifest
+        '''
+        if self.arrays is None:
+            return
+        
+        self.trim()
+        
+        for a in self.arrays.values():
+            a.flush()
+        
+        bands = self.arrays['bands']
+        weights = self.arrays['weights']
+        
+        manifest = {'format': 'vasp_unfold', 'version': 1,
+                    'orbitals': list(self.orbitals),
+                    'npoints': bands.shape[0], 'nbands': bands.shape[1],
+                    'nions': weights.shape[1]/len(self.orbitals),
+                    'ndim': weights.shape[3], 'nspin': self.nspin,
+                    'arrays': dict((name, {'file': name+'.npy', 
+                        'shape': list(a.shape), 'dtype': a.dtype.str})
+                        for name, a in self.arrays.items())}
+        
+        # Selected ions and orbitals (see parse.Orbitals)
+        for name in ('ions', 'columns'):
+            if getattr(self.orbitals, name, None) is not None:
+                manifest[name] = getattr(self.orbitals, name)
+        
+        manifest.update(self.info)
+        
+        with open(os.path.join(self.dirname, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        
+        self.arrays = None
+        
+        
+class ArrayWriter(BlockWriter):
+    '''Collects blocks of k-points yielded by iter_procar into
+    arrays in memory. Once the writer is closed, data holds the
+    same list as returned by parse_procar.
+    '''
+    
+    def __init__(self):
+        super(ArrayWriter, self).__init__()
+        
+        self.data = None
+        
+        
+    def allocate(self, name, dtype, shape):
+        return np.empty(shape, dtype)
+        
+        
+    def close(self):
+        '''Assembles the data list from the arrays
+        '''
+        if self.arrays is None:
+            return
+        
+        self.trim()
+        
+        self.data = [self.orbitals]+[self.arrays.get(name) 
+            for name in array_names]
+        
+        self.arrays = None
+        
+        
+class SpectralWriter(object):
+    '''Writes the spectral function of the blocks of k-points
+    yielded by unfold_block, with bands broadened on the grid
+    of energies and weighted by the orbital totals of the first
+    weight block. Every spin component s is written through a
+    memory map into prefix.spectral.s.npy as (npoints,nenergies)
+    array. Smearing and width are passed to spectral_function.
+    '''
+    
+    def __init__(self, prefix, energies, width, smearing='lorentzian',
+                 dtype=np.float32):
+        self.prefix = prefix
+        self.energies = np.asarray(energies, float)
+        self.width = width
+        self.smearing = smearing
+        self.dtype = dtype
+        self.arrays = {}
+    
+    
+    def path(self, s):
+        return '{0}.spectral.{1}.npy'.format(self.prefix, s)
+    
+    
+    def write(self, s, first, npoints, nspin, data):
+        '''Stores the spectral function of a block of k-points
+        of s-th spin component
+        '''
+        if s not in self.arrays:
+            self.arrays[s] = np.lib.format.open_memmap(self.path(s), 'w+',
+                self.dtype, (npoints, len(self.energies)))
+        
+        nk = len(data[1])
+        
+        # Orbital totals of every band
+        weights = np.sum(data[-2][...,0], axis=1)
+        
+        self.arrays[s][first:first+nk] = spectral_function(data[3], weights,
+            self.energies, self.width, self.smearing)
+    
+    
+    def close(self):
+        for a in self.arrays.values():
+            a.flush()
+        
+        self.arrays = {}
+    
+    
+class MultiWriter(object):
+    '''Passes the blocks of k-points to several writers
+    '''
+    
+    def __init__(self, writers):
+        self.writers = writers
+    
+    
+    def write(self, *args):
+        for w in self.writers:
+            w.write(*args)
+    
+    
+    def close(self):
+        for w in self.writers:
+            w.close()